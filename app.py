@@ -1,35 +1,36 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-import humanize
-from io import StringIO
+from io import BytesIO, StringIO
+import json
+import os
+import uuid
+from urllib.parse import urlencode
 
 from toc import Toc
-from datalayer import DataLayer
+from datalayer import indexed_tables, shared_datalayer
+from export import formats as export_formats
+from pipeline import ALL_COHORT, month_label
+import figures
+from figures import displayed, figure_cache
+import instrument
+from prefetch import prefetcher
+from instrument import span, timed
 
 st.set_page_config(layout="wide", page_title='CloudWalk Data Analyst Case')
 
 toc = Toc()
-dl = DataLayer()
+# DL_ATTACH points at a directory `python artifacts.py publish` keeps up to date; every server
+# process then maps the same published dataset instead of loading its own
+dl = shared_datalayer(attach_dir=os.environ.get('DL_ATTACH') or None)
 
-st.title('CloudWalk Data Analyst Case')
-
-with st.spinner("Loading data ⏳"):
+# the unpivot, cube and share table build in the background while the first sections render
+dl.warm()
 
-    df = dl.df
-    meta = dl.meta
-    dfu = dl.load_unpivoted()
+st.title('CloudWalk Data Analyst Case')
 
 # st.dataframe(dfg, hide_index=True)
 
 
-aux_date_cohort = df[['date','cohort']].copy()
-
-df['cohort'] = df['cohort'].dt.strftime('%Y-%m')
-df['date'] = df['date'].dt.strftime('%Y-%m')
-
-
 with st.container(border=True):
     st.header("Table of contents")
     toc.placeholder()
@@ -38,20 +39,78 @@ with st.container(border=True):
 
 
 
-with st.container(border=True):
+with st.container(border=True), span("app.intro"):
     toc.header("1. Intro")
     st.markdown("""
         This app was developed by Danilo Amorim in order to provide visual aid for the CloudWalk Data Analyst case.   
         Below is a sample of the data for the challenge
     """)
 
-    st.dataframe(df, hide_index=True)
+    st.dataframe(displayed(dl.df), hide_index=True)
+
+    @st.fragment
+    @timed("app.render_export")
+    def render_export():
+
+        # options from the source frame and metadata, both loaded for the sample above: the row index
+        # would hold up this section (and the next) until the unpivot behind it is built
+        source, meta = dl.df, dl.meta
+        dates = sorted(int(d) for d in source['date'].unique())
+        cohorts = sorted(int(c) for c in source['cohort'].unique()) + [ALL_COHORT]
+
+        cols = st.columns([1,1,2,2])
+        table = cols[0].selectbox("Table", list(indexed_tables), key='table_export')
+        fmt = cols[1].selectbox("Format", list(export_formats), key='format_export')
+        segment = cols[2].selectbox(
+            "Segment",
+            [None, "ALL", "ALL_ACTIVE", "SMB", "micro", "card_not_present", "inactive"],
+            format_func=lambda s: "every segment" if s is None else s,
+            key='segment_export'
+        )
+        cohort = cols[3].selectbox(
+            "Cohort",
+            [None] + cohorts,
+            format_func=lambda c: "every cohort" if c is None else month_label(c),
+            key='cohort_export'
+        )
+
+        cols = st.columns([3,2])
+        start, end = cols[0].select_slider("Months", dates, value=(dates[0], dates[-1]), format_func=month_label, key='months_export')
+        products = cols[1].multiselect("Products", sorted(meta['meta_product'].dropna().unique()), placeholder="every product", key='products_export')
+
+        selection = {
+            'table': table, 'segment': segment, 'cohort': None if cohort is None else month_label(cohort),
+            'product': products or None, 'start': month_label(start), 'end': month_label(end),
+        }
+        content_type, extension = export_formats[fmt]
+
+        # with the query service alongside (python server.py), the file streams from it in chunks;
+        # a download button has to hold the whole file in this process
+        service = os.environ.get('DL_SERVICE_URL')
+        if service:
+            query = urlencode({
+                k: ','.join(v) if isinstance(v, list) else v
+                for k, v in {**selection, 'format': fmt}.items() if v is not None
+            })
+            st.link_button("Download", f"{service.rstrip('/')}/export?{query}")
+        elif st.button("Prepare download", key='prepare_export'):
+            with st.spinner("Exporting ⏳"):
+                sink = BytesIO()
+                rows = dl.export(sink, fmt, **selection)
+            st.download_button(f"Download {rows:,} rows", sink, file_name=f"{table}.{extension}", mime=content_type)
+
+    with st.expander("Export the data"):
+        st.markdown("""
+            The unpivoted table (one row per date, cohort, segment and product) or the product share/rank table, for any slice.  
+            Months are written as YYYY-MM and values as stored.
+        """)
+        render_export()
 
 
 
 
 
-with st.container(border=True):
+with st.container(border=True), span("app.premises"):
     toc.header("2. Premises")
 
     st.markdown("""
@@ -68,7 +127,7 @@ with st.container(border=True):
 
 
 
-with st.container(border=True):
+with st.container(border=True), span("app.dataset_preparation"):
 
     toc.header("3. Dataset preparation")
 
@@ -82,21 +141,11 @@ with st.container(border=True):
     st.code("Avg Ticket (R$) = Total spent (R$) / Qty merchants (n)", language='excelFormula')
 
 
-    column_map = {
-        'transacted_amount': 'acquiring_merchants',
-        'account_balance': 'banking_merchants',
-        'account_cashin': 'banking_merchants',
-        'account_cashout': 'banking_merchants',
-        'infinitecard_transacted_amount': 'infinitecard_merchants',
-        'smartcash_amount_lent': 'smartcash_merchants',
-        'pix_credit_lent': 'pix_credit_merchants'
-    }
-
-    for money_col, qty_col in column_map.items():
-        df[ f"avg_{money_col}" ] = df[money_col] / df[qty_col]
+    # the avg_* columns (and months_since_register) come from the data layer's shared wide table
+    dfw = dl.load_wide()
 
     st.dataframe(
-        df[['date','cohort','segment'] + [c for c in df.columns if 'avg_' in c] ].sample(10) ,
+        displayed(dfw[['date','cohort','segment'] + [c for c in dfw.columns if 'avg_' in c] ].sample(10)) ,
         hide_index=True
     )
 
@@ -109,14 +158,12 @@ with st.container(border=True):
     # """)
     # st.code("months_since_register = (date - cohort) // 30", language='excelFormula')            
 
-    df['months_since_register'] = (aux_date_cohort['date'] - aux_date_cohort['cohort']).dt.days // 30
+    # st.dataframe(dfw[['date','cohort','months_since_register']].sample(10), hide_index=True)
 
-    # st.dataframe(df[['date','cohort','months_since_register']].sample(10), hide_index=True)
 
 
 
-
-with st.container(border=True):
+with st.container(border=True), span("app.analysis"):
 
     toc.header("4. Analysis")
 
@@ -132,6 +179,7 @@ with st.container(border=True):
     """)
 
     @st.fragment
+    @timed("app.render_cohort")
     def render_cohort():
         #@title Cohort Heatmap
 
@@ -167,55 +215,75 @@ with st.container(border=True):
         )
 
 
-        aux = df.copy()
-        if segment == 'ALL_ACTIVE':
-            aux = aux[ aux.segment != 'inactive' ]
-        elif segment != 'ALL':
-            aux = aux[ aux.segment == segment ]
+        with span("app.render_cohort.figure"):
+            fig = figure_cache.get(
+                'cohort_heatmap',
+                lambda: figures.cohort_heatmap(dl.cohort_heatmap(metric, segment), metric),
+                metric=metric, segment=segment, fingerprint=dl.fingerprint
+            )
 
-        cross_tab = pd.crosstab(
-            index=aux['cohort'],
-            columns=aux['date'],
-            values=aux[metric],
-            aggfunc='sum'
-        )
+        st.plotly_chart(fig, use_container_width=True)
 
-        def try_humanize(x):
-            try:
-                n = humanize.intword(int(x))            
-                n = n.replace("thousand","k")
-                n = n.replace("million","M")
-                return n
-            except:
-                return ""
-
-        text_matrix = cross_tab.applymap(try_humanize)
-
-        fig = px.imshow(
-            cross_tab, 
-            color_continuous_scale= px.colors.diverging.Temps_r,
-            labels = dict(
-                x='Month',
-                y='Cohort',
-                color=metric
-            ),
-            # text_auto=True
-        )
+    render_cohort()
 
-        fig.update_traces(
-            text=text_matrix.values,
-            texttemplate="%{text}", 
-            textfont_size=10 
-        )
 
-        fig.update_layout(
-            height=700, 
-            margin=dict(l=0, r=0, b=0, t=0, pad=4),            
+
+    toc.subheader("Retention analysis")
+
+    st.markdown("""
+    How much of each product's month 0 is still there N months after registration.  
+    Every curve point only counts the cohorts that already reached that month, against those same cohorts' month 0, so recent cohorts don't pull the later months down.  
+    The heatmap shows the same ratio for each cohort on its own.
+
+    **Please select a metric, a segment and a product to visualize**
+    """)
+
+    @st.fragment
+    @timed("app.render_retention")
+    def render_retention():
+
+        cols = st.columns([1,2,2])
+
+        metric = cols[0].selectbox(
+            "Metric",
+            ["total_merchants", "total_amount"],
+            key='metric_retention'
+        )
+        segment = cols[1].segmented_control(
+            "Segment" ,
+            ["ALL", "ALL_ACTIVE", "SMB", "micro", "card_not_present"] ,
+            default="ALL_ACTIVE",
+            selection_mode="single",
+            key='segment_retention'
+        )
+        product = cols[2].selectbox(
+            "Product (heatmap)",
+            list(figures.product_colors),
+            key='product_retention'
         )
 
-        st.plotly_chart(fig, use_container_width=True)
+        def curves():
+            return pd.concat([
+                dl.retention_curve(segment, p, metric).reset_index().assign(product=p)
+                for p in dl.retention_cube().products
+            ])
+
+        with span("app.render_retention.figures"):
+            fig = figure_cache.get(
+                'retention_curves',
+                lambda: figures.retention_curves(curves(), metric),
+                metric=metric, segment=segment, fingerprint=dl.fingerprint
+            )
+            st.plotly_chart(fig, use_container_width=True)
 
-    render_cohort()
+            fig = figure_cache.get(
+                'retention_heatmap',
+                lambda: figures.retention_heatmap(dl.retention_matrix(segment, product, metric), metric),
+                metric=metric, segment=segment, product=product, fingerprint=dl.fingerprint
+            )
+            st.plotly_chart(fig, use_container_width=True)
+
+    render_retention()
 
 
 
@@ -237,47 +305,78 @@ with st.container(border=True):
     """)
 
 
+    preference_segments = ["ALL", "ALL_ACTIVE", "SMB", "micro", "card_not_present","inactive"]
+    preference_charts = ['evolution', 'rank', 'share']
+
+    def preference_figure(chart, segment, cohort):
+
+        # the fragment and the prefetcher both build through here, so a prefetched figure is the one shown
+
+        def evolution_data():
+            # the cohort's rows through the row index; ALL and ALL_ACTIVE are segment rollups there
+            return displayed(dl.select(segment=segment, cohort=cohort, tweak_values_for_animation=True))
+
+        def share_data():
+            # already the one segment: the share table is sliced by (cohort, segment)
+            return displayed(dl.load_with_share(segment, cohort))
+
+        builds = {
+            'evolution': lambda: figures.evolution(evolution_data()),
+            'rank': lambda: figures.rank(share_data()),
+            'share': lambda: figures.share(share_data()),
+        }
+
+        return figure_cache.get(chart, builds[chart], segment=segment, cohort=cohort, fingerprint=dl.fingerprint)
+
+    def prefetch_owner():
+        # one owner per session: scheduling again cancels what this session had queued
+        return st.session_state.setdefault('prefetch_owner', uuid.uuid4().hex)
+
+    def prefetch_neighbours(cohorts, segment, cohort):
+
+        # users step through cohorts and segments one at a time: the cohorts either side of this one,
+        # then the other segments of this cohort, are built in the background while the charts are read
+        i = cohorts.index(cohort)
+        selections = [(segment, c) for c in cohorts[i + 1:i + 2] + cohorts[max(i - 1, 0):i]]
+        selections += [(s, cohort) for s in preference_segments if s != segment]
+
+        jobs = [
+            (f"{chart} {s} {month_label(c)}", lambda chart=chart, s=s, c=c: preference_figure(chart, s, c))
+            for s, c in selections for chart in preference_charts
+            if not figure_cache.contains(chart, segment=s, cohort=c, fingerprint=dl.fingerprint)
+        ]
+
+        prefetcher.schedule(prefetch_owner(), jobs)
+
     @st.fragment
-    def render_preference_charts(aux):
+    @timed("app.render_preference_charts")
+    def render_preference_charts():
+
+        # the selection moved: nothing queued for the last one should start while this one renders
+        prefetcher.cancel(prefetch_owner())
 
         cols = st.columns([2,2,1])
 
         segment = cols[0].segmented_control(
             "Segment" , 
-            ["ALL", "ALL_ACTIVE", "SMB", "micro", "card_not_present","inactive"] ,
+            preference_segments ,
             default="ALL",
             selection_mode="single",
             key='segment_v2'
         )
 
+        cohorts = [ALL_COHORT] + [int(c) for c in dl.row_index().values('cohort') if c != ALL_COHORT]
         cohort = cols[1].selectbox(
             "Cohort",
-            ['ALL'] + list(aux['cohort'].unique()) ,
-            index=0
+            cohorts ,
+            index=0,
+            format_func=month_label
         )
 
-        dfg = dl.load_with_share(segment, cohort)
-
-        aux = aux[ aux.cohort == cohort]
-
-        if segment == 'ALL_ACTIVE':
-            aux = aux[ aux.segment != 'inactive' ]
-        elif segment != 'ALL':
-            aux = aux[ aux.segment == segment ]
+        def cached(chart):
+            return preference_figure(chart, segment, cohort)
 
-
-
-        color_scale = px.colors.qualitative.Bold
-        
-        color_discrete_map = {
-            'acquiring': color_scale[0],
-            'banking': color_scale[1],
-            'infinitecard': color_scale[2],
-            'pixcredit': color_scale[3],
-            'smartcash': color_scale[4]
-        }
-
-        with st.spinner("Loading visualization ⏳"):
+        with st.spinner("Loading visualization ⏳"), span("app.render_preference_charts.figures"):
 
             st.markdown("##### Evolution of total amount and merchants per product and segment over time")
             st.markdown("""
@@ -286,30 +385,7 @@ with st.container(border=True):
             """)
             st.markdown("**Click the play icon [▶️] to visualize evolution of over time.**")
 
-            fig = px.scatter(
-                aux, 
-                x="total_amount", 
-                y="total_merchants", 
-                animation_frame="date", 
-                animation_group="segment",
-                size="avg_ticket",
-                text='segment' if aux.segment.nunique() > 1 else 'product',
-                color="product",
-                hover_name="segment",
-                log_x=True, 
-                log_y=True, 
-                size_max=55, 
-                range_x=[0.1, aux['total_amount'].max() * 1.5 ], 
-                range_y=[0.1, aux['total_merchants'].max() * 1.5],
-                color_discrete_map=color_discrete_map
-            )
-            fig.update_layout(
-                height=400, 
-                transition = { 'duration': 50_000 },
-                margin=dict(l=0, r=0, b=20, t=0, pad=4),
-            )
-            fig.update_traces(textfont=dict(size=10))
-
+            fig = cached('evolution')
 
             st.plotly_chart(fig)
 
@@ -319,33 +395,7 @@ with st.container(border=True):
                This chart ranks the most prefered products over time, according to average ticket spent on the refered period
             """)
 
-            aux = dfg[  dfg.segment == segment ]
-
-            fig = go.Figure()
-
-            for prod in aux['product'].unique():
-
-                aux_prod = aux [  aux['product'] == prod ]
-                current_color = color_discrete_map.get(prod, 'gray')
-                
-                fig.add_trace(
-                    go.Scatter(
-                        x = aux_prod['date'] ,
-                        y = list(aux_prod['rank']) ,
-                        mode = 'lines+markers',
-                        name = prod ,
-                        text =  [f"{t:.2%}" for t in aux_prod['percent_avg_ticket']]  ,
-                        textposition="top center" ,
-                        marker = dict(size=20, color=current_color),
-                        line=dict(color=current_color)
-                    )
-                )
-
-            fig.update_layout(
-                height = 250,
-                yaxis=dict(autorange='reversed'), 
-                margin=dict(l=0, r=0, b=20, t=0, pad=4),
-            )
+            fig = cached('rank')
 
             st.plotly_chart(fig)
 
@@ -354,39 +404,28 @@ with st.container(border=True):
                This chart presents how much a product was prefered over time, according to the share of average ticket spent.
             """)
 
-            fig = px.bar(
-                aux ,
-                x ='date',
-                y ='percent_avg_ticket',
-                range_y=[0,1],
-                barmode='relative',
-                color = 'product',
-                color_discrete_map=color_discrete_map ,
-                text = 'percent_avg_ticket'
-            )
+            fig = cached('share')
 
-            fig.update_layout(
-                height = 250,
-                margin=dict(l=0, r=0, b=20, t=0, pad=4),
-                yaxis_title=None,
-                yaxis=dict(
-                   tickformat=".0%"  # Formats as percentage with no decimal places
-                ),
-                xaxis_title=None,
-            )
+            st.plotly_chart(fig)
 
-            fig.update_traces(texttemplate='%{text:.1%}')
+        prefetch_neighbours(cohorts, segment, cohort)
 
-            st.plotly_chart(fig)
 
+    with st.spinner("Loading data ⏳"), span("app.load_data"):
+        dl.row_index()
 
-    render_preference_charts(dfu)
+    render_preference_charts()
 
 
 
-with st.container(border=True):
+with st.container(border=True), span("app.highlights"):
     toc.header("5. Highlights")
-    st.markdown("""
+
+    # the churn finding, read off one slice of the retention cube: month 3 since registration
+    churn = dl.retention_at(3).set_index(['segment', 'product'])
+    acquiring, banking = churn.loc[('ALL_ACTIVE', 'acquiring')], churn.loc[('ALL_ACTIVE', 'banking')]
+
+    st.markdown(f"""
                 
     *Higher volume of transacted amount was initially driven by increase of monthly registrations on 'micro' segment, and later on, by increase of customer profitability on the 'SMB' segment*  
     - Considering the all active segments, and the `transacted_amount` metric as starting point, it's noticeable that most cohorts newer than **2024-07** have **transacted more money thans older cohorts, since the very first month of registration**.
@@ -396,6 +435,7 @@ with st.container(border=True):
                 
     *The first 3 months since registration are critical to avoid customer churn on acquiring and banking*
     - When considering both `acquiring_merchants` and `banking_merchants` metrics, it's observable for all cohorts that there is a significant decrease of active customers after the 3rd month of registration.
+    - Across the {acquiring['cohorts']:.0f} active cohorts that reached it, month 3 keeps **{acquiring['retention']:.0%}** of the month 0 acquiring merchants and **{banking['retention']:.0%}** of the banking ones, down from {acquiring['previous']:.0%} and {banking['previous']:.0%} on month 2.
     - It is possible that these customers are still active in another products, though, but it remains as warning sign to work on customer retention on these products.
     - This seems to be a common pattern emerging from 'micro' segment.
 
@@ -427,7 +467,7 @@ with st.container(border=True):
 
 
 
-with st.container(border=True):
+with st.container(border=True), span("app.questions"):
     toc.header("6. Questions")
 
     with st.expander("1 - for each acquiring merchant segment, what are the preferred cross-sell products?"):
@@ -507,4 +547,11 @@ with st.container(border=True):
 
 
 
+if instrument.enabled():
+    with st.expander("Debug: timings"):
+        st.dataframe(pd.DataFrame(instrument.records()), hide_index=True)
+        st.download_button("Download JSON log", "\n".join(json.dumps(r) for r in instrument.records()), file_name="profile.jsonl")
+        st.dataframe(pd.DataFrame({'results': dl.results.stats(), 'figures': figure_cache.stats()}).T)
+        st.dataframe(pd.DataFrame([prefetcher.stats()]), hide_index=True)
+
 toc.generate()
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from cache import Bundle, BundleWriter, current_generation, fingerprint, set_current
+from datalayer import BUNDLE_DIR, CACHE_DIR, DATA_PATH, META_PATH, DataLayer, artifact_version, indexed_tables, source_stamp
+from pipeline import measure_columns
+
+
+def build(data_path=DATA_PATH, meta_path=META_PATH, out=BUNDLE_DIR, cache_dir=CACHE_DIR, float32=False, workers=None, name=None):
+
+    # computes every DataLayer output from the sources (or the columnar cache) and writes them
+    # to out/<fingerprint>/, the directory DataLayer looks in for these exact sources, or out/<name>/
+    dl = DataLayer(data_path, meta_path, cache_dir, float32=float32, bundle_dir=None, workers=workers)
+    cube = dl.cohort_cube()
+    retention = dl.retention_cube()
+
+    # the metadata the outputs were built with travels with them, for processes attached to the bundle
+    meta = dl.meta.set_index('column').to_dict(orient='index')
+
+    with BundleWriter(out, dl.fingerprint, dl.version, name=name, data_path=data_path, meta_path=meta_path, meta=meta, built_at=time.time()) as bundle:
+        bundle.write_frame('source', dl.source())
+        bundle.write_frame('wide', dl.load_wide())
+        bundle.write_frame('unpivoted', dl.unpivoted())
+        bundle.write_frame('tweaked', dl.load_unpivoted(columns=measure_columns))
+        bundle.write_frame('share', dl.share_table().frame)
+        bundle.write_frame('q1', dl.load_q1())
+        bundle.write_frame('q2', dl.load_q2())
+        bundle.write_array('cube', cube.values, labels=cube.labels)
+        bundle.write_array('retention', retention.values, labels=retention.labels)
+        for table in indexed_tables:
+            index = dl.row_index(table)
+            order, codes = index.stacked()
+            bundle.write_array(f"{table}_order", order, labels=index.labels)
+            bundle.write_array(f"{table}_codes", codes)
+
+    return Bundle(bundle.directory)
+
+
+def publish(data_path=DATA_PATH, meta_path=META_PATH, out=BUNDLE_DIR, cache_dir=CACHE_DIR, float32=False, workers=None, keep=2, force=False):
+
+    # builds a new generation next to the one in use and swaps CURRENT to it; processes attached
+    # with shared_datalayer(attach_dir=out) move over on their next call. Unchanged sources are not rebuilt.
+    os.makedirs(out, exist_ok=True)
+    version = artifact_version(float32)
+    key = fingerprint(data_path, meta_path, version=version)
+
+    current = current_generation(out)
+    if not force and current is not None and current.manifest.get('fingerprint') == key and current.manifest.get('version') == str(version):
+        return current, False
+
+    bundle = build(data_path, meta_path, out, cache_dir, float32, workers, name=f"{time.time_ns()}-{key}")
+    set_current(out, os.path.basename(bundle.directory), keep)
+
+    return bundle, True
+
+
+def same_frame(a, b):
+    try:
+        pd.testing.assert_frame_equal(a.reset_index(drop=True), b.reset_index(drop=True))
+        return True
+    except AssertionError:
+        return False
+
+
+def verify(data_path=DATA_PATH, meta_path=META_PATH, out=BUNDLE_DIR, float32=False, deep=False, workers=None):
+
+    # the bundle must exist for the current sources and every file must match its digest;
+    # with deep, every artifact is also recomputed from the sources (bypassing the cache) and compared
+    with tempfile.TemporaryDirectory(prefix='artifacts-verify-') as cache_dir:
+        dl = DataLayer(data_path, meta_path, cache_dir, float32=float32, bundle_dir=None, workers=workers)
+        bundle = Bundle.open(out, dl.fingerprint, dl.version)
+        if bundle is None:
+            return None, [f"no bundle for the current sources in {out} (fingerprint {dl.fingerprint}, version {dl.version})"]
+
+        problems = bundle.verify()
+        if problems or not deep:
+            return bundle, problems
+
+        expected = {
+            'source': dl.source,
+            'wide': dl.load_wide,
+            'unpivoted': dl.unpivoted,
+            'tweaked': lambda: dl.load_unpivoted(columns=measure_columns),
+            'share': lambda: dl.share_table().frame,
+            'q1': dl.load_q1,
+            'q2': dl.load_q2,
+        }
+        for name, compute in expected.items():
+            if not same_frame(bundle.read(name), compute()):
+                problems.append(f"{name}: differs from a fresh build")
+
+        arrays = [('cube', cube.labels, cube.values) for cube in [dl.cohort_cube()]]
+        arrays += [('retention', cube.labels, cube.values) for cube in [dl.retention_cube()]]
+        for table in indexed_tables:
+            index = dl.row_index(table)
+            order, codes = index.stacked()
+            arrays += [(f"{table}_order", index.labels, order), (f"{table}_codes", None, codes)]
+
+        for name, labels, values in arrays:
+            if name not in bundle:
+                problems.append(f"{name}: missing")
+            elif bundle.entry(name).get('labels') != labels or not np.array_equal(bundle.read_array(name), values, equal_nan=values.dtype.kind == 'f'):
+                problems.append(f"{name}: differs from a fresh build")
+
+    return bundle, problems
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Build or verify the prebuilt DataLayer artifact bundle')
+    parser.add_argument('command', choices=['build', 'verify', 'publish'])
+    parser.add_argument('--data', default=DATA_PATH)
+    parser.add_argument('--meta', default=META_PATH)
+    parser.add_argument('--out', default=BUNDLE_DIR, help='bundles are written to <out>/<source fingerprint>/')
+    parser.add_argument('--float32', action='store_true', help='build the float32 variant')
+    parser.add_argument('--deep', action='store_true', help='verify: also recompute every artifact and compare')
+    parser.add_argument('--workers', type=int, help='processes to precompute with; 0 uses every core (default: DL_WORKERS or 1)')
+    parser.add_argument('--keep', type=int, default=2, help='publish: generations to keep, the current one included')
+    parser.add_argument('--force', action='store_true', help='publish: rebuild even if the sources did not change')
+    parser.add_argument('--watch', type=float, help='publish: check the sources every this many seconds and republish when they change')
+    args = parser.parse_args(argv)
+
+    if args.command == 'publish':
+        stamp = None
+        while True:
+            if source_stamp(args.data, args.meta) != stamp:
+                stamp = source_stamp(args.data, args.meta)
+                bundle, published = publish(args.data, args.meta, args.out, float32=args.float32, workers=args.workers, keep=args.keep, force=args.force)
+                print(json.dumps({'generation': os.path.basename(bundle.directory), 'published': published}), flush=True)
+            if not args.watch:
+                return 0
+            time.sleep(args.watch)
+
+    if args.command == 'build':
+        bundle = build(args.data, args.meta, args.out, float32=args.float32, workers=args.workers)
+        problems = bundle.verify()
+    else:
+        bundle, problems = verify(args.data, args.meta, args.out, float32=args.float32, deep=args.deep, workers=args.workers)
+
+    if bundle is not None:
+        for name, entry in bundle.manifest['artifacts'].items():
+            print(json.dumps({'artifact': name, 'file': entry['file'], 'bytes': entry['bytes'], 'sha256': entry['sha256'][:16]}))
+    for problem in problems:
+        print(f"error: {problem}", file=sys.stderr)
+
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+import copy
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from engine import QueryEngine
+from instrument import span
+from pipeline import ALL_COHORT, splice_months
+
+# the unpivoted columns the on-demand queries read
+columns = ['date', 'cohort', 'segment', 'product', 'total_amount', 'total_merchants', 'avg_ticket']
+
+DEFAULT_BACKEND = 'arrow'
+
+
+def members(segments, segment, rollups):
+    # the base segments a selection covers: every segment a rollup keeps, or the segment itself
+    if segment in rollups:
+        return [s for s in segments if rollups[segment](s)]
+    return [segment]
+
+
+def share_frame(date, product, percent, rank, segment):
+
+    # what every backend returns for share(): rows in (date, rank) order, the dtypes fixed
+    frame = pd.DataFrame({
+        'date': np.asarray(date, dtype='int32'),
+        'segment': pd.Series(segment, index=range(len(date)), dtype=object),
+        'product': np.asarray(product, dtype=object),
+        'percent_avg_ticket': np.asarray(percent, dtype='float64'),
+        'rank': np.asarray(rank, dtype='int64'),
+    })
+
+    return frame.sort_values(['date', 'rank'], kind='stable', ignore_index=True)
+
+
+def totals_frame(segment, product, total_amount, total_merchants, months):
+
+    # what every backend returns for totals(): one row per (segment, product) with rows in the window
+    frame = pd.DataFrame({
+        'segment': np.asarray(segment, dtype=object),
+        'product': np.asarray(product, dtype=object),
+        'total_amount': np.asarray(total_amount),
+        'total_merchants': np.asarray(total_merchants),
+        'months': np.asarray(months, dtype='int64'),
+    })
+
+    return frame.sort_values(['segment', 'product'], kind='stable', ignore_index=True)
+
+
+class PandasBackend:
+
+    name = 'pandas'
+    # replace returns a new backend; readers of this one keep the rows they started on
+    in_place = False
+
+    def __init__(self, frame, rollups):
+        self.frame = frame[columns]
+        self.rollups = rollups
+
+    def latest(self):
+        return int(self.frame['date'].max())
+
+    def share(self, segment, cohort):
+
+        df = self.frame
+        mask = df['segment'].isin(members(df['segment'].unique(), segment, self.rollups))
+        if cohort != ALL_COHORT:
+            mask &= df['cohort'] == cohort
+
+        # sum(avg_ticket) keeps SQL's NULL for a group of only NaN
+        sums = df[mask].groupby(['date', 'product'], observed=True)['avg_ticket'].sum(min_count=1).reset_index()
+        sums['product'] = sums['product'].astype(str)
+
+        grouped = sums.groupby('date', sort=False)['avg_ticket']
+        sums['percent_avg_ticket'] = sums['avg_ticket'] / grouped.transform('sum').where(grouped.transform('count') > 0)
+
+        sums = sums.sort_values(['date', 'percent_avg_ticket', 'product'], ascending=[True, False, True], na_position='last', kind='stable', ignore_index=True)
+        rank = sums.groupby('date', sort=False).cumcount() + 1
+
+        return share_frame(sums['date'], sums['product'], sums['percent_avg_ticket'], rank, segment)
+
+    def totals(self, start, end):
+
+        df = self.frame
+        base = df[ (df['cohort'] != ALL_COHORT) & (df['date'] >= start) & (df['date'] <= end) ]
+        sums = base.groupby(['segment', 'product'], observed=True).agg(
+            total_amount=('total_amount', 'sum'), total_merchants=('total_merchants', 'sum'), months=('date', 'nunique')
+        ).reset_index()
+
+        return totals_frame(sums['segment'].astype(str), sums['product'].astype(str), sums['total_amount'], sums['total_merchants'], sums['months'])
+
+    def replace(self, months, part):
+        # splice_months keeps the canonical order the table was built in
+        backend = copy.copy(self)
+        backend.frame = splice_months(self.frame, part[columns])
+        return backend
+
+
+class SQLiteBackend:
+
+    name = 'sqlite'
+    # the database is shared by every connection, so replace changes it where it is
+    in_place = True
+
+    def __init__(self, frame, rollups):
+        self.engine = QueryEngine(frame[columns])
+        self.rollups = rollups
+        self.segments = list(frame['segment'].unique())
+
+    def latest(self):
+        return int(self.engine.query("select max(date) as date from data")['date'].iloc[0])
+
+    def share(self, segment, cohort):
+
+        selected = members(self.segments, segment, self.rollups)
+        placeholders = ', '.join('?' * len(selected))
+
+        dfg = self.engine.query(f"""
+                select
+                    date,
+                    product,
+                    percent_avg_ticket,
+                    row_number() over (partition by date order by percent_avg_ticket desc, product) as rank
+                from (
+                    select
+                        date,
+                        product,
+                        avg_ticket / sum(avg_ticket) over (partition by date) as percent_avg_ticket
+                    from (
+                        select
+                            date,
+                            product,
+                            sum(avg_ticket) avg_ticket
+                        from data
+                        where segment in ({placeholders})
+                            and (? = {ALL_COHORT} or cohort = ?)
+                        group by
+                            date,
+                            product
+                    ) x
+                ) y
+            """, [str(s) for s in selected] + [cohort, cohort])
+
+        return share_frame(dfg['date'], dfg['product'], dfg['percent_avg_ticket'], dfg['rank'], segment)
+
+    def totals(self, start, end):
+
+        dfg = self.engine.query(f"""
+                select
+                    segment,
+                    product,
+                    sum(total_amount) as total_amount,
+                    sum(total_merchants) as total_merchants,
+                    count(distinct date) as months
+                from data
+                where date between ? and ?
+                    and cohort != {ALL_COHORT}
+                group by
+                    segment,
+                    product
+            """, [start, end])
+
+        return totals_frame(dfg['segment'], dfg['product'], dfg['total_amount'], dfg['total_merchants'], dfg['months'])
+
+    def replace(self, months, part):
+        self.segments = list(dict.fromkeys(self.segments + list(part['segment'].unique())))
+        self.engine.replace_partition('date', months, part[columns])
+        return self
+
+
+class ArrowBackend:
+
+    name = 'arrow'
+    in_place = False
+
+    def __init__(self, frame, rollups):
+        # categoricals become dictionary columns and NaN becomes null, as in the other engines
+        with span('backend.arrow_table', rows=len(frame)):
+            self.table = pa.Table.from_pandas(frame[columns], preserve_index=False)
+        self.rollups = rollups
+        self.segments = list(frame['segment'].unique())
+
+    def latest(self):
+        return int(pc.max(self.table['date']).as_py())
+
+    def share(self, segment, cohort):
+
+        t = self.table
+        mask = pc.is_in(t['segment'], value_set=pa.array([str(s) for s in members(self.segments, segment, self.rollups)], pa.string()))
+        if cohort != ALL_COHORT:
+            mask = pc.and_(mask, pc.equal(t['cohort'], cohort))
+
+        null_if_empty = pc.ScalarAggregateOptions(min_count=1)
+        sums = t.filter(mask).group_by(['date', 'product']).aggregate([('avg_ticket', 'sum', null_if_empty)])
+        totals = sums.group_by('date').aggregate([('avg_ticket_sum', 'sum', null_if_empty)])
+        sums = sums.join(totals, 'date')
+
+        # 0 / 0 is NaN in Arrow and NULL in SQL; nulls sort last whichever way the sort goes
+        percent = pc.divide(sums['avg_ticket_sum'], sums['avg_ticket_sum_sum'])
+        percent = pc.if_else(pc.is_nan(percent), pa.scalar(None, pa.float64()), percent)
+        ranked = pa.table({'date': sums['date'], 'product': pc.cast(sums['product'], pa.string()), 'percent_avg_ticket': percent})
+        ranked = ranked.sort_by([('date', 'ascending'), ('percent_avg_ticket', 'descending'), ('product', 'ascending')], null_placement='at_end')
+
+        # row_number() over (partition by date): position in the sorted rows minus where the date starts
+        dates = ranked['date'].to_numpy()
+        starts = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]])
+        rank = np.arange(len(dates)) - np.repeat(starts, np.diff(np.r_[starts, len(dates)])) + 1
+
+        return share_frame(dates, ranked['product'].to_pylist(), ranked['percent_avg_ticket'].to_numpy(zero_copy_only=False), rank, segment)
+
+    def totals(self, start, end):
+
+        t = self.table
+        mask = pc.and_(
+            pc.not_equal(t['cohort'], ALL_COHORT),
+            pc.and_(pc.greater_equal(t['date'], start), pc.less_equal(t['date'], end))
+        )
+        sums = t.filter(mask).group_by(['segment', 'product']).aggregate([
+            ('total_amount', 'sum'), ('total_merchants', 'sum'), ('date', 'count_distinct')
+        ])
+
+        return totals_frame(
+            pc.cast(sums['segment'], pa.string()).to_pylist(), pc.cast(sums['product'], pa.string()).to_pylist(),
+            sums['total_amount_sum'].to_numpy(), sums['total_merchants_sum'].to_numpy(), sums['date_count_distinct'].to_numpy()
+        )
+
+    def replace(self, months, part):
+        backend = copy.copy(self)
+        backend.segments = list(dict.fromkeys(self.segments + list(part['segment'].unique())))
+        kept = self.table.filter(pc.invert(pc.is_in(self.table['date'], value_set=pa.array(months, pa.int32()))))
+        backend.table = pa.concat_tables([kept, pa.Table.from_pandas(part[columns], preserve_index=False)], promote_options='permissive')
+        return backend
+
+
+backends = {
+    'pandas': PandasBackend,
+    'sqlite': SQLiteBackend,
+    'arrow': ArrowBackend,
+}
+
+
+def backend_name(name=None):
+    # None reads DL_BACKEND (default: the Arrow engine, the fastest on this data shape)
+    name = name or os.environ.get('DL_BACKEND', DEFAULT_BACKEND)
+    if name not in backends:
+        raise ValueError(f"backend must be one of {sorted(backends)}, not {name!r}")
+    return name
@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from backends import backend_name, backends
+from datalayer import META_PATH, DataLayer, segment_rollups
+from pipeline import as_month_key, read_meta
+from precompute import worker_count
+
+BASE_SEGMENTS = ['SMB', 'card_not_present', 'micro', 'inactive']
+BASE_ROWS = 506
+
+# product -> (share of merchants using it, mean ticket in R$, months after the first cohort it launches)
+PRODUCT_PROFILE = {
+    'acquiring': (0.95, 2500, 0),
+    'banking': (0.95, 150, 0),
+    'infinitecard': (0.01, 300, 0),
+    'smartcash': (0.05, 4000, 2),
+    'pixcredit': (0.02, 1500, 5),
+}
+
+
+def synthesize(meta, scale=1, seed=0, start='2024-01'):
+
+    # grows history up to 10 years first, then adds segments until the row count is about scale x data.gz
+    rng = np.random.default_rng(seed)
+    n_months = int(min(120, round(16 * scale ** 0.25)))
+    target_rows = BASE_ROWS * scale
+    n_segments = max(len(BASE_SEGMENTS), round(target_rows / (n_months * (n_months + 1) / 2)))
+    segments = BASE_SEGMENTS + [f"segment_{i:04d}" for i in range(n_segments - len(BASE_SEGMENTS))]
+
+    months = pd.date_range(start, periods=n_months, freq='MS')
+    date_idx, cohort_idx = np.tril_indices(n_months)
+    segment_idx = np.repeat(np.arange(len(segments)), len(date_idx))
+    date_idx, cohort_idx = np.tile(date_idx, len(segments)), np.tile(cohort_idx, len(segments))
+    age = date_idx - cohort_idx
+
+    # cohorts shrink with age, with the sharp drop after the third month the heatmaps show
+    cohort_size = rng.lognormal(9, 1, size=(len(segments), n_months))[segment_idx, cohort_idx]
+    retention = np.where(age < 3, 1.0, 0.45) * np.exp(-age / 36)
+    merchants = cohort_size * retention
+
+    df = pd.DataFrame({
+        'date': months[date_idx],
+        'cohort': months[cohort_idx],
+        'segment': np.array(segments, dtype=object)[segment_idx],
+    })
+
+    metrics = meta[ (meta['meta_class'] == 'metric') & (meta['meta_calculation'] == False) ]
+    for product, rows in metrics.groupby('meta_product', sort=False):
+        share, ticket, launch = PRODUCT_PROFILE.get(product, (0.05, 1000, 0))
+        # older customers adopt credit products more, as the cohort heatmaps suggest
+        adoption = share * (1 + age / 12) * (date_idx >= launch)
+        users = rng.poisson(merchants * np.clip(adoption, 0, 1))
+
+        for column, kind in zip(rows['column'], rows['meta_kind']):
+            if kind == 'unit':
+                df[column] = users
+            else:
+                df[column] = np.round(users * rng.lognormal(np.log(ticket), 0.5, size=len(df))).astype('int64')
+
+    return df
+
+
+def measure(run, memory):
+
+    if memory:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+
+    run()
+
+    result = {'wall_s': time.perf_counter() - wall, 'cpu_s': time.process_time() - cpu}
+    if memory:
+        result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    return result
+
+
+def stages(workdir, data_path, meta_path, workers=None, backend=None):
+
+    metric, segment = 'transacted_amount', 'ALL_ACTIVE'
+
+    def fresh(cold=False):
+        cache_dir = os.path.join(workdir, '.cache')
+        if cold:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        return DataLayer(data_path, meta_path, cache_dir, workers=workers, backend=backend)
+
+    def warm():
+        dl = fresh()
+        dl.query_backend()
+        dl.cohort_cube()
+        dl.share_table()
+        dl.window_index()
+        dl.retention_cube()
+        dl.row_index()
+        dl.results.clear()
+        return dl
+
+    def unpivoted():
+        dl = fresh(cold=True)
+        dl.unpivoted()
+        return dl
+
+    def share_sweep(dl):
+        cohorts = ['ALL'] + sorted(dl.load_wide()['cohort'].unique())
+        for s in list(segment_rollups) + sorted(dl.df['segment'].unique()):
+            for c in cohorts:
+                dl.load_with_share(s, c)
+
+    def selections(dl):
+        cohorts = ['ALL'] + sorted(dl.load_wide()['cohort'].unique())
+        return [(s, c) for s in list(segment_rollups) + sorted(dl.df['segment'].unique()) for c in cohorts]
+
+    def sweep_setup():
+        dl = warm()
+        dl.load_unpivoted()
+        return dl, selections(dl)
+
+    def select_sweep(setup):
+        dl, selected = setup
+        for s, c in selected:
+            dl.select(segment=s, cohort=c, tweak_values_for_animation=True)
+
+    def mask_sweep(setup):
+        # the boolean masks the preference charts filtered with before the row index
+        dl, selected = setup
+        aux = dl.load_unpivoted()
+        for s, c in selected:
+            data = aux[ aux.cohort == as_month_key(c) ]
+            if s == 'ALL_ACTIVE':
+                data = data[ data.segment != 'inactive' ]
+            elif s != 'ALL':
+                data = data[ data.segment == s ]
+
+    def export(fmt):
+        # the whole unpivoted table, written and dropped: peak memory is the chunk, not the table
+        def run(dl):
+            with open(os.devnull, 'wb') as sink:
+                dl.export(sink, fmt)
+        return run
+
+    def heatmap_crosstab(dfw):
+        aux = dfw.copy()
+        if segment == 'ALL_ACTIVE':
+            aux = aux[ aux.segment != 'inactive' ]
+        pd.crosstab(index=aux['cohort'], columns=aux['date'], values=aux[metric], aggfunc='sum')
+
+    # name -> (setup, measured run); setup output is passed to run and is not measured
+    return {
+        'datalayer_init': (lambda: None, lambda _: fresh()),
+        'load_unpivoted_cold': (lambda: fresh(cold=True), lambda dl: dl.load_unpivoted()),
+        'load_unpivoted_warm': (lambda: fresh(), lambda dl: dl.load_unpivoted()),
+        'query_backend': (unpivoted, lambda dl: dl.query_backend()),
+        'load_q1': (warm, lambda dl: dl.load_q1()),
+        'load_q2': (warm, lambda dl: dl.load_q2()),
+        'load_with_share': (warm, lambda dl: dl.load_with_share(segment, 'ALL')),
+        'load_with_share_sweep': (warm, share_sweep),
+        'query_with_share': (warm, lambda dl: dl.query_with_share(segment, 'ALL')),
+        'query_totals': (warm, lambda dl: dl.query_totals()),
+        'share_table': (unpivoted, lambda dl: dl.share_table()),
+        'window_index': (unpivoted, lambda dl: dl.window_index()),
+        'load_q1_window_sweep': (warm, lambda dl: [dl.load_q1(n) for n in range(1, 13)]),
+        'heatmap_crosstab': (lambda: fresh().load_wide(), heatmap_crosstab),
+        'cohort_cube': (fresh, lambda dl: dl.cohort_cube()),
+        'cohort_heatmap': (warm, lambda dl: dl.cohort_heatmap(metric, segment)),
+        'retention_cube': (unpivoted, lambda dl: dl.retention_cube()),
+        'retention_at': (warm, lambda dl: dl.retention_at(3)),
+        'row_index': (unpivoted, lambda dl: dl.row_index()),
+        'select_sweep': (sweep_setup, select_sweep),
+        'mask_sweep': (sweep_setup, mask_sweep),
+        'export_csv': (warm, export('csv')),
+        'export_parquet': (warm, export('parquet')),
+        'export_arrow': (warm, export('arrow')),
+    }
+
+
+def run(scales, repeat=1, memory=True, only=None, meta_path=META_PATH, seed=0, workers=None, backend=None):
+
+    meta = read_meta(meta_path)
+
+    for scale in scales:
+        workdir = tempfile.mkdtemp(prefix=f"bench-{scale}x-")
+        try:
+            data_path = os.path.join(workdir, 'data.gz')
+            df = synthesize(meta, scale, seed)
+            df.to_pickle(data_path)
+
+            for name, (setup, stage) in stages(workdir, data_path, meta_path, workers, backend).items():
+                if only and name not in only:
+                    continue
+
+                for i in range(repeat):
+                    ctx = setup()
+                    record = {'stage': name, 'scale': scale, 'rows': len(df), 'workers': worker_count(workers), 'backend': backend_name(backend), 'repeat': i}
+                    record.update(measure(lambda: stage(ctx), memory=False))
+                    if memory:
+                        ctx = setup()
+                        record['peak_mb'] = measure(lambda: stage(ctx), memory=True)['peak_mb']
+                    yield record
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark the DataLayer pipeline on synthetic data shaped by meta.json')
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 100], help='multiples of the data.gz row count (1, 100, 10000, ...)')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--stage', nargs='*', help='only run these stages')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass that measures peak memory')
+    parser.add_argument('--meta', default=META_PATH)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help='DataLayer precompute processes; 0 uses every core (default: DL_WORKERS or 1)')
+    parser.add_argument('--backend', choices=sorted(backends), help='engine behind the query_* stages and, once named, the load_with_share and load_q* ones (default: DL_BACKEND or arrow)')
+    parser.add_argument('--out', help='append JSON lines here instead of stdout')
+    args = parser.parse_args(argv)
+
+    out = open(args.out, 'a') if args.out else sys.stdout
+    try:
+        for record in run(args.scale, args.repeat, not args.no_memory, args.stage, args.meta, args.seed, args.workers, args.backend):
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+    finally:
+        if args.out:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
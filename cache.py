@@ -0,0 +1,385 @@
+import hashlib
+import json
+import os
+import glob
+import shutil
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from instrument import timed
+
+
+def fingerprint(*paths, version=None):
+
+    digest = hashlib.sha256(f"v{version}".encode())
+
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()[:16]
+
+
+def file_digest(path):
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def map_table(path):
+    # the table's buffers point into the map and keep it open; nothing is read until they are used
+    with pa.memory_map(path, 'r') as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def read_table(path, columns=None):
+    return table_frame(map_table(path), columns)
+
+
+def table_frame(table, columns=None):
+
+    if columns is not None:
+        table = table.select(columns)
+
+    return table.to_pandas(split_blocks=True)
+
+
+def arrow_table(frame):
+
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+
+    # NaN is written as NaN rather than null: a float column with a validity bitmap has to be
+    # copied to be read back, one without maps straight into the frame
+    for i, column in enumerate(table.column_names):
+        if frame[column].dtype.kind == 'f' and table.column(i).null_count:
+            table = table.set_column(i, table.field(i), pa.array(frame[column].to_numpy(), from_pandas=False))
+
+    return table
+
+
+def write_table(path, frame):
+
+    table = arrow_table(frame)
+
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    return table.num_rows
+
+
+def fingerprint_frame(frame, base=''):
+
+    digest = hashlib.sha256(base.encode())
+    digest.update(pd.util.hash_pandas_object(frame, index=False).to_numpy().tobytes())
+
+    return digest.hexdigest()[:16]
+
+
+class ColumnarCache:
+
+    def __init__(self, directory='.cache', version=None):
+        # layers of different versions (float32 and float64 ones) can share a directory: each only
+        # ever replaces entries of its own version
+        self.directory = directory
+        self.version = version
+
+    def path(self, name, key):
+        suffix = '' if self.version is None else f".v{self.version}"
+        return os.path.join(self.directory, f"{name}-{key}{suffix}.arrow")
+
+    @timed('cache.read')
+    def read(self, name, key, columns=None):
+
+        path = self.path(name, key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            return read_table(path, columns)
+        except (pa.ArrowInvalid, OSError):
+            os.remove(path)
+            return None
+
+    @contextmanager
+    def writing(self, name, key):
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        path = self.path(name, key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        try:
+            yield tmp_path
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        # older entries of this name and version only; an unversioned cache leaves versioned ones be
+        for stale in glob.glob(self.path(name, '*')):
+            if stale != path and os.path.basename(stale).count('.') == os.path.basename(path).count('.'):
+                os.remove(stale)
+
+    @timed('cache.write')
+    def write(self, name, key, frame):
+        with self.writing(name, key) as tmp_path:
+            write_table(tmp_path, frame)
+
+
+class Bundle:
+
+    # a directory of prebuilt DataLayer outputs for one source fingerprint: Arrow IPC files for
+    # frames, .npy files for arrays and a manifest with their digests. Built by artifacts.py.
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        # artifact name -> its mapped table or array, once pin() has opened them
+        self.pinned = {}
+
+    @classmethod
+    def open(cls, root, key, version):
+
+        try:
+            bundle = cls(os.path.join(root, key))
+        except (OSError, ValueError):
+            return None
+
+        if bundle.manifest.get('version') != str(version) or bundle.manifest.get('fingerprint') != key:
+            return None
+
+        return bundle
+
+    def __contains__(self, name):
+        return name in self.manifest['artifacts']
+
+    def pin(self):
+
+        # maps every artifact up front, for a process attached to a published generation: a later
+        # publish prunes older generations, and a removed file stays readable only through a map
+        # opened before it went. Opening a map reads nothing, so this costs no more than the lookup
+        for name, entry in self.manifest['artifacts'].items():
+            path = self.path(name)
+            self.pinned[name] = np.load(path, mmap_mode='r') if entry['file'].endswith('.npy') else map_table(path)
+
+        return self
+
+    def entry(self, name):
+        return self.manifest['artifacts'][name]
+
+    def path(self, name):
+        return os.path.join(self.directory, self.entry(name)['file'])
+
+    @timed('bundle.read')
+    def read(self, name, columns=None):
+        if name in self.pinned:
+            return table_frame(self.pinned[name], columns)
+        return read_table(self.path(name), columns)
+
+    def read_array(self, name):
+        # memory-mapped read-only, so every process serving the bundle shares the same pages
+        if name in self.pinned:
+            return self.pinned[name]
+        return np.load(self.path(name), mmap_mode='r')
+
+    def verify(self):
+
+        problems = []
+        for name, entry in self.manifest['artifacts'].items():
+            path = self.path(name)
+            if not os.path.exists(path):
+                problems.append(f"{name}: {entry['file']} is missing")
+            elif file_digest(path) != entry['sha256']:
+                problems.append(f"{name}: {entry['file']} does not match its sha256")
+
+        return problems
+
+
+class BundleWriter:
+
+    def __init__(self, root, key, version, name=None, **info):
+        self.directory = os.path.join(root, name or key)
+        self.tmp_directory = f"{self.directory}.{os.getpid()}.tmp"
+        self.manifest = dict(info, version=str(version), fingerprint=key, artifacts={})
+
+    def __enter__(self):
+        shutil.rmtree(self.tmp_directory, ignore_errors=True)
+        os.makedirs(self.tmp_directory)
+        return self
+
+    def _add(self, name, file, **entry):
+        path = os.path.join(self.tmp_directory, file)
+        self.manifest['artifacts'][name] = dict(entry, file=file, sha256=file_digest(path), bytes=os.path.getsize(path))
+
+    def write_frame(self, name, frame):
+        rows = write_table(os.path.join(self.tmp_directory, f"{name}.arrow"), frame)
+        self._add(name, f"{name}.arrow", rows=rows)
+
+    def write_array(self, name, values, **entry):
+        np.save(os.path.join(self.tmp_directory, f"{name}.npy"), np.ascontiguousarray(values))
+        self._add(name, f"{name}.npy", shape=list(values.shape), **entry)
+
+    def __exit__(self, exc_type, exc, tb):
+
+        if exc_type is not None:
+            shutil.rmtree(self.tmp_directory, ignore_errors=True)
+            return False
+
+        with open(os.path.join(self.tmp_directory, 'manifest.json'), 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+
+        # the bundle appears complete or not at all
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.replace(self.tmp_directory, self.directory)
+
+        return False
+
+
+def nbytes(value):
+
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._computing = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        # a peek: neither counts as a hit nor refreshes the entry
+        with self._lock:
+            return key in self._entries
+
+    def _lookup(self, key):
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key][0]
+
+        return False, None
+
+    def get_or_compute(self, key, compute):
+
+        # values come back as stored, shared with every other caller: they must not be written to
+        found, value = self._lookup(key)
+        if found:
+            return value
+
+        # concurrent callers of the same key wait for the one computing it instead of repeating
+        # the work; compute must not wait on a key that waits on this one
+        with self._lock:
+            computing = self._computing.setdefault(key, threading.Lock())
+
+        try:
+            with computing:
+                found, value = self._lookup(key)
+                if found:
+                    return value
+
+                with self._lock:
+                    self.misses += 1
+                value = compute()
+                self.put(key, value)
+        finally:
+            with self._lock:
+                if self._computing.get(key) is computing and not computing.locked():
+                    del self._computing[key]
+
+        return value
+
+    def put(self, key, value):
+
+        size = nbytes(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            }
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+
+# file in a publish directory naming the generation (bundle directory) readers should use
+CURRENT = 'CURRENT'
+
+
+def current_generation(root):
+
+    try:
+        with open(os.path.join(root, CURRENT)) as f:
+            name = f.read().strip()
+        return Bundle(os.path.join(root, name))
+    except (OSError, ValueError):
+        return None
+
+
+def set_current(root, name, keep=2):
+
+    # readers see the old generation or the new one, never a mix: the pointer is swapped atomically
+    # and the generation it names is complete before that
+    tmp_path = os.path.join(root, f"{CURRENT}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        f.write(name)
+    os.replace(tmp_path, os.path.join(root, CURRENT))
+
+    # older generations go, except the last few a reader may have just looked up; processes
+    # attached to a removed one pinned its files (Bundle.pin) and keep their pages until they let go
+    generations = sorted(
+        d for d in os.listdir(root)
+        if d != name and os.path.exists(os.path.join(root, d, 'manifest.json'))
+    )
+    for stale in generations[:max(len(generations) - keep + 1, 0)]:
+        shutil.rmtree(os.path.join(root, stale), ignore_errors=True)
@@ -0,0 +1,181 @@
+import numpy as np
+import pandas as pd
+
+
+def grown(buffer, values, shape):
+
+    # a writable array holding values in its leading corner with room for shape: buffer itself when
+    # it already has that room, otherwise a new one with a quarter again as many cohorts and dates
+    # (a year at least), so appending a month reallocates only every so often. Fresh cells are NaN
+    if buffer.flags.writeable and buffer.shape[:-2] == shape[:-2] and all(b >= s for b, s in zip(buffer.shape[-2:], shape[-2:])):
+        return buffer
+
+    capacity = tuple(shape[:-2]) + tuple(s + max(12, s // 4) for s in shape[-2:])
+    buffer = np.full(capacity, np.nan, dtype=values.dtype)
+    buffer[tuple(slice(0, n) for n in values.shape)] = values
+
+    return buffer
+
+
+class CohortCube:
+
+    def __init__(self, values, metrics, segments, cohorts, dates, rollups=(), buffer=None, present=None):
+
+        # values is a dense metric x segment x cohort x date array, NaN where no row exists; it may be
+        # the leading corner of a larger buffer that later months are appended into (see append)
+        self.values = values
+        self._buffer = values if buffer is None else buffer
+        self.values.flags.writeable = False
+        self.metrics = list(metrics)
+        self.segments = list(segments)
+        self.cohorts = pd.Index(cohorts, name='cohort')
+        self.dates = pd.Index(dates, name='date')
+        self.rollups = list(rollups)
+
+        self._metric_pos = {m: i for i, m in enumerate(self.metrics)}
+        self._segment_pos = {s: i for i, s in enumerate(self.segments)}
+
+        # rows and columns a crosstab would keep for each segment: only observed cohorts and dates,
+        # as segment x cohort and segment x date masks
+        if present is None:
+            observed = ~np.isnan(values).all(axis=0)
+            present = (observed.any(axis=2), observed.any(axis=1))
+        self._present = present
+        self._rows = [np.flatnonzero(p) for p in present[0]]
+        self._cols = [np.flatnonzero(p) for p in present[1]]
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    @property
+    def labels(self):
+        # everything but the values, JSON-serializable; cohorts and dates are month keys
+        return {
+            'metrics': self.metrics,
+            'segments': self.segments,
+            'cohorts': [int(c) for c in self.cohorts],
+            'dates': [int(d) for d in self.dates],
+            'rollups': self.rollups,
+        }
+
+    @classmethod
+    def from_labels(cls, values, labels):
+        return cls(
+            values, labels['metrics'], labels['segments'],
+            np.asarray(labels['cohorts'], dtype='int32'), np.asarray(labels['dates'], dtype='int32'),
+            labels['rollups']
+        )
+
+    @classmethod
+    def build(cls, df, metrics, rollups):
+
+        segment_codes, segments = pd.factorize(df['segment'], sort=True)
+        cohort_codes, cohorts = pd.factorize(df['cohort'], sort=True)
+        date_codes, dates = pd.factorize(df['date'], sort=True)
+
+        n_seg, n_coh, n_date = len(segments), len(cohorts), len(dates)
+        cell = (segment_codes * n_coh + cohort_codes) * n_date + date_codes
+        size = n_seg * n_coh * n_date
+
+        # missing values sum as zero, like crosstab's aggfunc='sum'
+        data = df[list(metrics)].to_numpy(dtype='float64')
+        data = np.where(np.isnan(data), 0.0, data)
+
+        base = np.stack([np.bincount(cell, weights=data[:, i], minlength=size) for i in range(len(metrics))])
+        base = base.reshape(len(metrics), n_seg, n_coh, n_date)
+        counts = np.bincount(cell, minlength=size).reshape(n_seg, n_coh, n_date)
+
+        labels = list(rollups) + list(segments)
+        members = [np.isin(segments, [s for s in segments if keep(s)]) for keep in rollups.values()]
+
+        values = np.concatenate([np.stack([base[:, m].sum(axis=1) for m in members], axis=1), base], axis=1)
+        counts = np.concatenate([np.stack([counts[m].sum(axis=0) for m in members]), counts])
+
+        values[:, counts == 0] = np.nan
+
+        return cls(values, metrics, labels, cohorts, dates, rollups)
+
+    @classmethod
+    def stack(cls, parts):
+
+        # cubes built from the same rows for different metrics, joined in the order given
+        first = parts[0]
+        if len(parts) == 1:
+            return first
+
+        values = np.concatenate([p.values for p in parts])
+
+        return cls(values, [m for p in parts for m in p.metrics], first.segments, first.cohorts, first.dates, first.rollups)
+
+    def appends(self, part):
+        # part only adds months after the last one here, for segments and older cohorts already here
+        return (
+            len(self.dates) > 0 and part.metrics == self.metrics and part.rollups == self.rollups
+            and part.dates.min() > self.dates[-1] and set(part.segments) <= set(self.segments)
+            and (part.cohorts.isin(self.cohorts) | (part.cohorts > self.cohorts[-1])).all()
+        )
+
+    def append(self, part):
+
+        # the part's months become new date columns (and its new cohorts new rows) of the same buffer.
+        # Only cells outside this cube's values are written, so it and anyone still reading it see no
+        # change, and the cost follows the months added rather than the history kept
+        cohorts = self.cohorts.append(part.cohorts.difference(self.cohorts))
+        dates = self.dates.append(part.dates)
+        n_coh, n_date = len(self.cohorts), len(self.dates)
+
+        buffer = grown(self._buffer, self.values, (len(self.metrics), len(self.segments), len(cohorts), len(dates)))
+        buffer[:, :, :len(cohorts), n_date:len(dates)] = np.nan
+        buffer[:, :, n_coh:len(cohorts), :n_date] = np.nan
+
+        segments = [self._segment_pos[s] for s in part.segments]
+        rows, columns = cohorts.get_indexer(part.cohorts), np.arange(n_date, len(dates))
+        buffer[np.ix_(np.arange(len(self.metrics)), segments, rows, columns)] = part.values
+
+        observed = ~np.isnan(part.values).all(axis=0)
+        present_rows = np.zeros((len(self.segments), len(cohorts)), dtype=bool)
+        present_rows[:, :n_coh] = self._present[0]
+        present_rows[np.ix_(segments, rows)] |= observed.any(axis=2)
+        present_cols = np.zeros((len(self.segments), len(dates)), dtype=bool)
+        present_cols[:, :n_date] = self._present[1]
+        present_cols[np.ix_(segments, columns)] = observed.any(axis=1)
+
+        values = buffer[:, :, :len(cohorts), :len(dates)]
+        return CohortCube(values, self.metrics, self.segments, cohorts, dates, self.rollups, buffer, (present_rows, present_cols))
+
+    def replace(self, part):
+
+        # part is a cube over whole months: those months are taken from it, everything else is kept.
+        # New months at the end are appended in place; anything else rebuilds the array
+        if self.appends(part):
+            return self.append(part)
+
+        base_segments = sorted(set(self.segments[len(self.rollups):]) | set(part.segments[len(part.rollups):]))
+        segments = self.rollups + base_segments
+        cohorts = self.cohorts.union(part.cohorts).sort_values()
+        dates = self.dates.union(part.dates).sort_values()
+
+        kept = np.where(self.dates.isin(part.dates), np.nan, self.values)
+
+        values = np.full((len(self.metrics), len(segments), len(cohorts), len(dates)), np.nan)
+        for cube, cube_values in ((self, kept), (part, part.values)):
+            values[np.ix_(
+                np.arange(len(self.metrics)),
+                [segments.index(s) for s in cube.segments],
+                cohorts.get_indexer(cube.cohorts),
+                dates.get_indexer(cube.dates)
+            )] = cube_values
+
+        return CohortCube(values, self.metrics, segments, cohorts, dates, self.rollups)
+
+    def heatmap(self, metric, segment):
+
+        s = self._segment_pos[segment]
+        rows, cols = self._rows[s], self._cols[s]
+
+        return pd.DataFrame(
+            self.values[self._metric_pos[metric], s][np.ix_(rows, cols)],
+            index=self.cohorts[rows],
+            columns=self.dates[cols]
+        )
@@ -1,252 +1,647 @@
+import contextlib
+import functools
+import inspect
+import os
 import pandas as pd
-import sqlite3
+import threading
+
+from backends import backend_name, backends
+from cache import Bundle, ColumnarCache, ResultCache, current_generation, fingerprint, fingerprint_frame
+from cube import CohortCube
+from export import EXPORT_CHUNK_ROWS, export_format, export_schema, record_batches, write_batches
+from instrument import timed
+from precompute import MIN_CUBE_CELLS, chunks, month_partitions, partition_count, run, worker_count
+from retention import RetentionCube
+from rowindex import RowIndex
+from share import ShareTable, share_table
+from window import WindowIndex
+from pipeline import (
+    PIPELINE_VERSION, apply_schema, as_month_key, concat, dtype_schema, int_div, measure_columns,
+    meta_frame, read_meta, read_source, source_frame, splice_months, stream_unpivot, unpivot, widen, write_source
+)
+
+DATA_PATH = 'data.gz'
+META_PATH = 'meta.json'
+CACHE_DIR = '.cache'
+BUNDLE_DIR = 'artifacts'
+# budget for memoized results, shared by every session of the process
+RESULT_CACHE_BYTES = int(os.environ.get('DL_RESULT_CACHE_MB', '256')) * 1024 * 1024
+
+# load_q1 and load_q2 summarize this many trailing months, up to the latest month with data
+Q_WINDOW = 3
+
+segment_rollups = {
+    'ALL': lambda segment: True,
+    'ALL_ACTIVE': lambda segment: segment != 'inactive'
+}
+
+
+# the tables row_index, select and export read through a row index
+indexed_tables = ('unpivoted', 'share')
+
+
+def row_selection(segment=None, cohort=None, product=None, date=None, start=None, end=None):
+
+    # RowIndex keys from a selection: months and cohorts as 'YYYY-MM' or month keys, each key a value
+    # or a list, and start/end as an inclusive date range in place of date
+    if date is not None and (start is not None or end is not None):
+        raise ValueError("give date or start/end, not both")
+
+    def keys(wanted):
+        if wanted is None:
+            return None
+        return [as_month_key(w) for w in wanted] if isinstance(wanted, (list, tuple)) else as_month_key(wanted)
+
+    if start is not None or end is not None:
+        date = slice(keys(start), keys(end))
+    else:
+        date = keys(date)
+
+    return {'segment': segment, 'cohort': keys(cohort), 'product': product, 'date': date}
+
+
+# precompute tasks; module level so worker processes can import them
+def share_months(dfu):
+    return share_table(dfu, segment_rollups)
+
+
+def cube_metrics(dfw, metrics):
+    return CohortCube.build(dfw, metrics, segment_rollups)
+
+
+def memoized(method):
+
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, shared=False, **kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        # results are pure functions of the arguments and the data, so the fingerprint is part of
+        # the key: nothing computed before an ingest or reload is ever served after it
+        key = (method.__name__, self.fingerprint) + tuple(
+            (name, tuple(value) if isinstance(value, list) else value)
+            for name, value in list(bound.arguments.items())[1:]
+        )
+        value = self.results.get_or_compute(key, lambda: method(self, *args, **kwargs))
+
+        # the cached result is shared by every session, so a caller gets a copy of its own to edit;
+        # shared=True hands out the cached one itself, for the data layer's own reads, which never write
+        if shared or not isinstance(value, (pd.DataFrame, pd.Series)):
+            return value
+        return value.copy()
+
+    return wrapper
+
+
+def artifact_version(float32=False):
+    return f"{PIPELINE_VERSION}-float32" if float32 else PIPELINE_VERSION
+
+
+def source_stamp(*paths):
+    return tuple((os.stat(p).st_mtime_ns, os.stat(p).st_size) for p in paths)
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+def shared_datalayer(data_path=DATA_PATH, meta_path=META_PATH, cache_dir=CACHE_DIR, result_cache_bytes=RESULT_CACHE_BYTES, bundle_dir=BUNDLE_DIR, attach_dir=None):
+
+    key = (data_path, meta_path, cache_dir, bundle_dir, attach_dir)
+
+    if attach_dir is not None:
+        # a loader process publishes generations (`python artifacts.py publish`); this process maps
+        # whichever one CURRENT names and moves to the next when the pointer changes
+        generation = current_generation(attach_dir)
+        if generation is not None and generation.manifest.get('version') == str(artifact_version()):
+            with _shared_lock:
+                dl = _shared.get(key)
+                if dl is None or dl.bundle is None or dl.bundle.directory != generation.directory:
+                    dl = _shared[key] = DataLayer(data_path, meta_path, cache_dir, result_cache_bytes, bundle=generation)
+            return dl
+
+    stamp = source_stamp(data_path, meta_path)
+
+    with _shared_lock:
+        dl = _shared.get(key)
+
+        if dl is not None and dl.stamp is None:
+            # attached before, but nothing usable is published any more
+            dl = None
+
+        if dl is not None and dl.stamp != stamp:
+            # touched files only invalidate when their content actually changed
+            if fingerprint(data_path, meta_path, version=dl.version) == dl.fingerprint:
+                dl.stamp = stamp
+            else:
+                dl = None
+
+        if dl is None:
+            dl = _shared[key] = DataLayer(data_path, meta_path, cache_dir, result_cache_bytes, bundle_dir=bundle_dir)
+
+    return dl
+
 
 class DataLayer:
 
-    def __init__(self):
-        self.df = pd.read_pickle('data.gz')
-        self.meta = self.load_meta()
+    @timed('datalayer.init')
+    def __init__(self, data_path=DATA_PATH, meta_path=META_PATH, cache_dir=CACHE_DIR, result_cache_bytes=RESULT_CACHE_BYTES, stream_memory=None, float32=False, bundle_dir=BUNDLE_DIR, workers=None, bundle=None, backend=None):
+        self.data_path = data_path
+        self.meta_path = meta_path
+        self.stream_memory = stream_memory
+        # processes the unpivot, cube and share builds are spread over
+        self.workers = worker_count(workers)
+        # the engine behind the on-demand query_* methods: pandas, sqlite or arrow. Named here or with
+        # DL_BACKEND, it also answers load_with_share and the load_q* windows, in place of the
+        # precomputed share table and window index
+        self.backend = backend_name(backend)
+        self.on_demand = bool(backend or os.environ.get('DL_BACKEND'))
+        self.float_dtype = 'float32' if float32 else 'float64'
+        self.version = artifact_version(float32)
+        self.cache = ColumnarCache(cache_dir, self.version)
+        if bundle is not None:
+            # attached to a published generation, which stands in for the sources: nothing is read
+            # from data_path and every output is mapped read-only from the bundle
+            self.stamp = None
+            self.fingerprint = bundle.manifest['fingerprint']
+            # mapped now, so the generation stays readable after a later publish prunes it
+            self.bundle = bundle.pin()
+        else:
+            self.stamp = source_stamp(data_path, meta_path)
+            self.fingerprint = fingerprint(data_path, meta_path, version=self.version)
+            # prebuilt outputs for exactly these sources, if `python artifacts.py build` made them
+            self.bundle = Bundle.open(bundle_dir, self.fingerprint, self.version) if bundle_dir else None
+        self._meta = self.load_meta()
+        self.schema = dtype_schema(self._meta, self.float_dtype)
+        self.results = ResultCache(result_cache_bytes)
+        # every dataset below is built on first access and shared afterwards
+        self._df = None
+        self._df_lock = threading.Lock()
+        self._backend = None
+        self._backend_lock = threading.Lock()
+        self._cube = None
+        self._cube_lock = threading.Lock()
+        self._dfu = None
+        self._dfu_lock = threading.Lock()
+        self._share = None
+        self._share_lock = threading.Lock()
+        self._window = None
+        self._window_lock = threading.Lock()
+        self._retention = None
+        self._retention_lock = threading.Lock()
+        self._rows = {}
+        self._rows_lock = threading.Lock()
+        # one ingest at a time; each swaps every dataset above in one step
+        self._ingest_lock = threading.Lock()
+        self._warm_thread = None
+
+    @property
+    def df(self):
+        return self.source().copy()
+
+    @property
+    def meta(self):
+        return self._meta.copy()
 
     def load_meta(self):
-        return pd.read_json( open('meta.json','r'), orient='index' ).reset_index().rename(columns={'index':'column'})
-    
-    def load_unpivoted(self, tweak_values_for_animation=True):
-
-        columns_to_rename = {'value_x': 'total_amount', 'value_y': 'total_merchants', 'value':'avg_ticket'}
-
-        try:
-            dfu = pd.read_pickle("data_unpivoted.gz")
-        except:
-
-            dfu: pd.DataFrame = self.df.copy()
-            meta = self.meta
-
-            id_vars = list(meta[ meta['meta_class'] =='dimension' ]['column'])
-            get_product = lambda metric:  meta[ meta['column'] == metric ]['meta_product'].iloc[0]
-
-
-            column_map = {
-                'transacted_amount': 'acquiring_merchants',
-                'account_balance': 'banking_merchants',
-                'account_cashin': 'banking_merchants',
-                'account_cashout': 'banking_merchants',
-                'infinitecard_transacted_amount': 'infinitecard_merchants',
-                'smartcash_amount_lent': 'smartcash_merchants',
-                'pix_credit_lent': 'pix_credit_merchants'
-            }
-
-            for money_col, qty_col in column_map.items():
-                dfu[ f"avg_{money_col}" ] = dfu[money_col] / dfu[qty_col]
-
-            dfu['months_since_register'] = (dfu['date'] - dfu['cohort']).dt.days // 30
-
-            dfu['cohort'] = dfu['cohort'].dt.strftime('%Y-%m')
-            dfu['date'] = dfu['date'].dt.strftime('%Y-%m')
-
-            aux_money: pd.DataFrame = dfu.melt(
-                id_vars = id_vars ,
-                var_name = 'metric' ,
-                value_vars = meta[ (meta['meta_kind'] == 'money') & (meta['meta_active'] == True) & (meta['meta_calculation'] == False) ]['column']
-            ).copy()
-
-            aux_qty = dfu.melt(
-                id_vars = id_vars ,
-                var_name = 'metric' ,
-                value_vars = meta[ (meta['meta_kind'] == 'unit') ]['column']
-            ).copy()
-
-            aux_avg = dfu.melt(
-                id_vars = id_vars ,
-                var_name = 'metric' ,
-                value_vars = meta[ (meta['meta_kind'] == 'money') & (meta['meta_active'] == True) & (meta['meta_calculation'] == True) ]['column']
-            ).copy()
-
-            aux_money['product'] = aux_money['metric'].apply(get_product)
-            aux_qty['product'] = aux_qty['metric'].apply(get_product)
-            aux_avg['product'] = aux_avg['metric'].apply(get_product)
-
-            id_vars += ['product']
-
-            dfu = aux_money.merge(aux_qty, on=id_vars).merge(aux_avg, on=id_vars)
-            dfu = dfu.rename(columns=columns_to_rename)
-            dfu = dfu[  id_vars + list(columns_to_rename.values())]
-            dfu = dfu.fillna(0)
-
-            with sqlite3.connect(":memory:") as conn:
-
-                dfu.to_sql('data', conn, index=False)
-
-                dfu = pd.read_sql_query(f"""
-                    select
-                        date,
-                        cohort,
-                        segment,
-                        months_since_register,
-                        product,
-                        total_amount ,
-                        total_merchants ,
-                        avg_ticket                
-                    from data
-                                        
-                    union all
-                                        
-                    select 
-                        date,
-                        'ALL' cohort,
-                        segment,
-                        null months_since_register,
-                        product,
-                        sum(total_amount) as total_amount,
-                        sum(total_merchants) as total_merchants,
-                        sum(total_amount)/sum(total_merchants) as avg_ticket
-                    from data
-                    group by
-                        date,
-                        segment,
-                        product
-                """, conn
-                )
-
-
-            dfu.to_pickle("data_unpivoted.gz")
+        # a bundle carries the metadata it was built with, which is the one that labels its data even
+        # once meta_path has moved on
+        if self.bundle is not None and 'meta' in self.bundle.manifest:
+            return meta_frame(self.bundle.manifest['meta'])
+        return read_meta(self.meta_path)
+
+    def from_bundle(self, name, columns=None):
+        if self.bundle is not None and name in self.bundle:
+            return self.bundle.read(name, columns)
+        return None
+
+    @timed('datalayer.source')
+    def source(self):
+
+        with self._df_lock:
+            if self._df is None:
+                df = self.from_bundle('source')
+                self._df = df if df is not None else apply_schema(read_source(self.data_path), self.schema)
+
+        return self._df
+
+    def warm(self, loaders=None):
+
+        # builds the heavy datasets on a daemon thread while the caller renders something else;
+        # a foreground call to the same loader waits on its lock and gets the shared result.
+        # Errors are dropped here and resurface when the foreground makes that call itself.
+        if loaders is None:
+            answers = (self.query_backend,) if self.on_demand else (self.share_table, self.window_index)
+            loaders = (self.unpivoted, self.cohort_cube) + answers + (self.retention_cube, self.row_index)
+
+        def run():
+            for load in loaders:
+                try:
+                    load()
+                except Exception:
+                    pass
+
+        if self._warm_thread is None:
+            self._warm_thread = threading.Thread(target=run, name='datalayer-warm', daemon=True)
+            self._warm_thread.start()
+
+        return self._warm_thread
+
+    @timed('datalayer.load_wide')
+    @memoized
+    def load_wide(self):
+
+        dfw = self.from_bundle('wide')
+        if dfw is not None:
+            return dfw
+
+        return widen(self.source(), self._meta, self.float_dtype)
+
+    @timed('datalayer.cohort_cube')
+    def cohort_cube(self):
+
+        with self._cube_lock:
+            if self._cube is None:
+                if self.bundle is not None and 'cube' in self.bundle:
+                    self._cube = CohortCube.from_labels(self.bundle.read_array('cube'), self.bundle.entry('cube')['labels'])
+                else:
+                    self._cube = self.build_cube(self.load_wide(shared=True))
+
+        return self._cube
+
+    def build_cube(self, dfw):
+
+        # every metric is binned independently, so the cube is built in metric slices
+        metrics = list(self._meta[ self._meta['meta_class'] == 'metric' ]['column'])
+        parts = chunks(metrics, partition_count(len(dfw) * len(metrics), self.workers, MIN_CUBE_CELLS))
+        if len(parts) == 1:
+            return cube_metrics(dfw, metrics)
+
+        return CohortCube.stack(run(cube_metrics, [(dfw[['segment', 'cohort', 'date'] + m], m) for m in parts], self.workers))
+
+    @timed('datalayer.cohort_heatmap')
+    @memoized
+    def cohort_heatmap(self, metric, segment):
+        return self.cohort_cube().heatmap(metric, segment)
+
+    @timed('datalayer.unpivoted')
+    def unpivoted(self):
+
+        with self._dfu_lock:
+            if self._dfu is None:
+                dfu = self.from_bundle('unpivoted')
+                if dfu is None:
+                    dfu = self.cache.read('unpivoted', self.fingerprint)
+                if dfu is None and self.stream_memory is not None:
+                    with self.cache.writing('unpivoted', self.fingerprint) as path:
+                        stream_unpivot(self.data_path, path, self._meta, self.stream_memory, self.schema)
+                    # already canonical and in this schema's dtypes, so the file maps in without a copy
+                    dfu = apply_schema(self.cache.read('unpivoted', self.fingerprint), self.schema)
+                elif dfu is None:
+                    dfu = self.build_unpivoted()
+                    self.cache.write('unpivoted', self.fingerprint, dfu)
+                self._dfu = dfu
+
+        return self._dfu
+
+    @timed('datalayer.load_unpivoted')
+    @memoized
+    def load_unpivoted(self, tweak_values_for_animation=True, columns=None):
+
+        dfu = None
+        if columns is not None and self._dfu is None:
+            dfu = self.from_bundle('unpivoted', columns)
+            if dfu is None:
+                dfu = self.cache.read('unpivoted', self.fingerprint, columns)
+
+        if dfu is None:
+            dfu = self.unpivoted().copy(deep=False)
+            if columns is not None:
+                dfu = dfu[columns]
 
         if tweak_values_for_animation:
-            for c in columns_to_rename.values():
-                dfu[c] = dfu[c].apply(lambda v: v if v > 0 else 0.1)
+            # bundles carry the tweaked measures, so processes sharing one do not each make a copy
+            tweaked = self.from_bundle('tweaked', [c for c in measure_columns if c in dfu])
+            for c in measure_columns:
+                if c in dfu:
+                    dfu[c] = tweaked[c] if tweaked is not None else dfu[c].where(dfu[c] > 0, 0.1)
 
         return dfu
 
-    def load_q1(self):
-
-        dfu = self.load_unpivoted(tweak_values_for_animation=False)
-       
-        with sqlite3.connect(":memory:") as conn:
-
-            dfu.to_sql('data', conn, index=False)
-
-            dfg = pd.read_sql_query(f""" 
-                select 
-                    segment ,
-                    product ,
-                    sum(total_amount) as total_amount ,
-                    sum(total_merchants) as total_merchants ,
-                    sum(total_amount) / sum(total_merchants) as avg_ticket
-                from data
-                where date in ('2025-02','2025-03','2025-04') and
-                cohort !='ALL'
-                group by
-                    segment ,
-                    product
-                order by 
-                    segment, avg_ticket desc
-            """,conn)
+    @timed('datalayer.build_unpivoted')
+    def build_unpivoted(self):
+
+        # months are unpivoted and rolled up independently; parts come back in month order,
+        # so joining them keeps the canonical order
+        dfw = self.load_wide(shared=True)
+        parts = month_partitions(dfw, partition_count(len(dfw), self.workers))
+        dfu = run(unpivot, [(p, self._meta) for p in parts], self.workers)
+
+        return apply_schema(dfu[0] if len(dfu) == 1 else concat(dfu), self.schema)
+
+    @timed('datalayer.ingest')
+    def ingest(self, rows, persist=False):
+
+        with self._ingest_lock:
+            return self.ingest_rows(rows, persist)
+
+    def ingest_rows(self, rows, persist):
+
+        df = self.source()
+
+        missing = set(df.columns) - set(rows.columns)
+        if missing:
+            raise ValueError(f"ingested rows are missing columns: {sorted(missing)}")
+
+        rows = apply_schema(rows[list(df.columns)], self.schema)
+
+        # only the new months go through the pipeline; unpivot, the ALL rollup and the
+        # share/rank windows are all partitioned by date, so older months are untouched
+        dfw = widen(rows, self._meta, self.float_dtype)
+        part = apply_schema(unpivot(dfw, self._meta), self.schema)
+        months = [int(m) for m in part['date'].unique()]
+
+        dfu = splice_months(self.unpivoted(), part)
+        source = concat([df[ ~df['date'].isin(rows['date'].unique()) ], rows])
+
+        # every replacement is built before anything is swapped, each from the dataset it replaces;
+        # readers meanwhile keep getting the old ones, which none of this changes
+        replaced = {}
+        builds = {
+            '_cube': (self._cube_lock, lambda cube: cube.replace(self.build_cube(dfw))),
+            '_share': (self._share_lock, lambda share: share.replace(share_table(part, segment_rollups))),
+            '_window': (self._window_lock, lambda window: window.replace(WindowIndex.build(part))),
+            '_retention': (self._retention_lock, lambda retention: retention.replace(RetentionCube.build(part, segment_rollups))),
+            '_backend': (self._backend_lock, lambda backend: backend if backend.in_place else backend.replace(months, part)),
+        }
+        for slot, (lock, build) in builds.items():
+            with lock:
+                current = getattr(self, slot)
+            replaced[slot] = (current, build(current) if current is not None else None)
+
+        # then everything changes together, the fingerprint with it, under every lock in the order
+        # the loaders nest them: no call can pair the new fingerprint with an old dataset
+        locks = [
+            self._rows_lock, self._backend_lock, self._retention_lock, self._window_lock,
+            self._cube_lock, self._share_lock, self._dfu_lock, self._df_lock,
+        ]
+        with contextlib.ExitStack() as held:
+            for lock in locks:
+                held.enter_context(lock)
+
+            for slot, (current, replacement) in replaced.items():
+                # a dataset first built while this ran came from the old rows: it is built again on next use
+                if getattr(self, slot) is not current:
+                    replacement = None
+                elif slot == '_backend' and replacement is not None and replacement.in_place:
+                    replacement = replacement.replace(months, part)
+                setattr(self, slot, replacement)
+
+            self._df = source
+            self._dfu = dfu
+            # every row after the first new month moved, so the positions are rebuilt on next use
+            self._rows = {}
+            # the bundle describes the sources before these rows
+            self.bundle = None
+            self.fingerprint = fingerprint_frame(rows, self.fingerprint)
+
+        # results memoized under the old fingerprint are never asked for again
+        self.results.clear()
+
+        if persist:
+            write_source(source_frame(self.source(), self.schema), self.data_path)
+            self.stamp = source_stamp(self.data_path, self.meta_path)
+            self.fingerprint = fingerprint(self.data_path, self.meta_path, version=self.version)
+            self.cache.write('unpivoted', self.fingerprint, dfu)
+            with self._share_lock:
+                if self._share is not None:
+                    self.cache.write('share', self.fingerprint, self._share.frame)
+
+        return part
+
+    def indexed(self, table='unpivoted'):
+
+        # a table and its row index, built together so the one always describes the other. The
+        # share table has rows of its own for the segment rollups, so only the unpivoted one expands them
+        if table not in indexed_tables:
+            raise ValueError(f"table must be one of {list(indexed_tables)}, not {table!r}")
+
+        with self._rows_lock:
+            if table not in self._rows:
+                if table == 'unpivoted':
+                    frame, rollups = self.unpivoted(), {'segment': segment_rollups}
+                else:
+                    frame, rollups = self.share_table().frame, None
+                if self.bundle is not None and f"{table}_order" in self.bundle:
+                    # mapped read-only like the table itself, so processes sharing a bundle share the index
+                    index = RowIndex.from_labels(
+                        self.bundle.read_array(f"{table}_order"), self.bundle.read_array(f"{table}_codes"),
+                        self.bundle.entry(f"{table}_order")['labels'], frame.dtypes
+                    )
+                else:
+                    index = RowIndex.build(frame, rollups=rollups)
+                self._rows[table] = (frame, index)
+
+        return self._rows[table]
+
+    @timed('datalayer.row_index')
+    def row_index(self, table='unpivoted'):
+        return self.indexed(table)[1]
+
+    @timed('datalayer.select')
+    def select(self, segment=None, cohort=None, product=None, date=None, start=None, end=None, tweak_values_for_animation=False, columns=None):
+
+        # unpivoted rows matching every key given, found through the row index in time proportional
+        # to the rows returned: a copy of one contiguous run (a month range), or a take otherwise. Each key takes a value or a list; segments include the rollups, months and
+        # cohorts are 'YYYY-MM' or month keys, and start/end bound the dates instead of date
+        return self.row_index().select(
+            self.load_unpivoted(tweak_values_for_animation, columns, shared=True),
+            **row_selection(segment, cohort, product, date, start, end), copy=True
+        )
+
+    @timed('datalayer.export')
+    def export(self, sink, fmt='csv', table='unpivoted', segment=None, cohort=None, product=None, date=None, start=None, end=None, columns=None, chunk_rows=EXPORT_CHUNK_ROWS):
+
+        # streams the rows of a table matching the selection (keys as in select) to the binary file
+        # object sink, as CSV, Parquet or an Arrow IPC stream. Rows go chunk_rows at a time straight
+        # from the resident table, so memory stays at one chunk however large the export; values are
+        # the stored ones, never tweaked. Returns the rows written
+        fmt = export_format(fmt)
+        frame, index = self.indexed(table)
+        if columns is not None:
+            unknown = set(columns) - set(frame.columns)
+            if unknown:
+                raise ValueError(f"unknown columns: {sorted(unknown)}")
+            frame = frame[list(columns)]
+
+        schema = export_schema(frame)
+        chunks = index.chunks(frame, chunk_rows, **row_selection(segment, cohort, product, date, start, end))
+
+        return write_batches(sink, fmt, schema, record_batches(chunks, schema))
+
+    @timed('datalayer.query_backend')
+    def query_backend(self):
+
+        with self._backend_lock:
+            if self._backend is None:
+                self._backend = backends[self.backend](self.unpivoted(), segment_rollups)
+
+        return self._backend
+
+    @timed('datalayer.window_index')
+    def window_index(self):
+
+        with self._window_lock:
+            if self._window is None:
+                self._window = WindowIndex.build(self.unpivoted())
+
+        return self._window
+
+    @timed('datalayer.window_totals')
+    @memoized
+    def window_totals(self, months=Q_WINDOW, start=None, end=None):
+
+        # sums per segment and product over the trailing `months` months up to end (default: the
+        # latest month with data), or over start..end; months are 'YYYY-MM' or month keys
+        if self.on_demand:
+            return self.backend_totals(months, start, end)
+
+        index = self.window_index()
+        end = index.latest() if end is None else as_month_key(end)
+        if start is not None:
+            return index.totals(as_month_key(start), end)
+
+        return index.trailing(months, end)
+
+    @timed('datalayer.query_totals')
+    @memoized
+    def query_totals(self, months=Q_WINDOW, start=None, end=None):
+        # the same sums computed on demand by the query backend; window_totals reads them from the index
+        return self.backend_totals(months, start, end)
+
+    def backend_totals(self, months, start, end):
+
+        backend = self.query_backend()
+        end = backend.latest() if end is None else as_month_key(end)
+        start = end - months + 1 if start is None else as_month_key(start)
+
+        return backend.totals(start, end)
+
+    @timed('datalayer.retention_cube')
+    def retention_cube(self):
+
+        with self._retention_lock:
+            if self._retention is None:
+                if self.bundle is not None and 'retention' in self.bundle:
+                    self._retention = RetentionCube.from_labels(self.bundle.read_array('retention'), self.bundle.entry('retention')['labels'])
+                else:
+                    self._retention = RetentionCube.build(self.unpivoted(), segment_rollups)
+
+        return self._retention
+
+    @timed('datalayer.retention_curve')
+    @memoized
+    def retention_curve(self, segment, product, metric='total_merchants'):
+        # every cohort that reached each month since registration, against those cohorts' month 0
+        return self.retention_cube().curve(segment, product, metric)
+
+    @timed('datalayer.retention_matrix')
+    @memoized
+    def retention_matrix(self, segment, product, metric='total_merchants'):
+        # one row per cohort, one column per month since registration, each against its own month 0
+        return self.retention_cube().matrix(segment, product, metric)
+
+    @timed('datalayer.retention_at')
+    @memoized
+    def retention_at(self, months_since_register, metric='total_merchants'):
+        # every segment and product at one month since registration, next to the month before it
+        return self.retention_cube().at(months_since_register, metric)
+
+    @timed('datalayer.load_q1')
+    @memoized
+    def load_q1(self, months=Q_WINDOW, start=None, end=None):
+
+        if (months, start, end) == (Q_WINDOW, None, None):
+            dfg = self.from_bundle('q1')
+            if dfg is not None:
+                return dfg
+
+        totals = self.window_totals(months, start, end, shared=True)
+
+        dfg = pd.DataFrame({
+            'segment': totals['segment'].astype(object),
+            'product': totals['product'].astype(object),
+            'total_amount': totals['total_amount'],
+            'total_merchants': totals['total_merchants'],
+            'avg_ticket': int_div(totals['total_amount'], totals['total_merchants']),
+        })
 
-        return dfg
-    
-
-    def load_q2(self):
-
-        dfu = self.load_unpivoted(tweak_values_for_animation=False)
-       
-        with sqlite3.connect(":memory:") as conn:
-
-            dfu.to_sql('data', conn, index=False)
-
-            dfg = pd.read_sql_query(f""" 
-                select 
-                    x.*,
-                    row_number() over (partition by product order by average_merchants_monthly desc) as rank
-                from (
-                    select 
-                        product ,
-                        segment ,
-                        sum(total_merchants) as total_merchants ,
-                        sum(total_merchants) / count(distinct date) as average_merchants_monthly
-                    from data
-                    where date in ('2025-02','2025-03','2025-04')
-                    and cohort != 'ALL'
-                    group by
-                        segment ,
-                        product
-                    order by 
-                        product, average_merchants_monthly desc
-                ) x
-
-            """,conn)
+        # order by segment, avg_ticket desc: NULL tickets last, ties in the order SQLite gave them
+        return dfg.sort_values(['segment', 'avg_ticket', 'product'], ascending=[True, False, False], na_position='last', kind='stable', ignore_index=True)
+
+    @timed('datalayer.load_q2')
+    @memoized
+    def load_q2(self, months=Q_WINDOW, start=None, end=None):
+
+        if (months, start, end) == (Q_WINDOW, None, None):
+            dfg = self.from_bundle('q2')
+            if dfg is not None:
+                return dfg
+
+        totals = self.window_totals(months, start, end, shared=True)
+
+        # merchants per month with data, ranked within each product
+        dfg = pd.DataFrame({
+            'product': totals['product'].astype(object),
+            'segment': totals['segment'].astype(object),
+            'total_merchants': totals['total_merchants'],
+            'average_merchants_monthly': int_div(totals['total_merchants'], totals['months']),
+        })
+        dfg = dfg.sort_values(['product', 'average_merchants_monthly', 'segment'], ascending=[True, False, True], na_position='last', kind='stable', ignore_index=True)
+        dfg['rank'] = dfg.groupby('product', sort=False).cumcount() + 1
 
         return dfg
-    
-    def load_with_share(self, segment,cohort):
-
-        dfu = self.load_unpivoted(tweak_values_for_animation=False)
-        
-        where_cohort = ''
-        if cohort != 'ALL':
-            where_cohort = f"and cohort = '{cohort}'"
-
-
-        with sqlite3.connect(":memory:") as conn:
-
-            dfu.to_sql('data', conn, index=False)
-
-            dfg = pd.read_sql_query(f""" 
-                select 
-                    date,
-                    segment,
-                    product,
-                    percent_avg_ticket ,
-                    row_number() over (partition by date, segment order by percent_avg_ticket desc) as rank
-                from (
-                    select
-                        date,
-                        segment,
-                        product,
-                        avg_ticket / sum(avg_ticket) over (partition by date, segment) as percent_avg_ticket
-                    from (
-                        select 
-                            date,
-                            segment,
-                            product,
-                            sum(avg_ticket) avg_ticket
-                        from data
-                        where 1=1 
-                        {where_cohort}
-                        group by
-                            date,
-                            segment,
-                            product  
-                                    
-                        UNION ALL
-                        
-                        select 
-                            date,
-                            'ALL' segment,
-                            product,
-                            sum(avg_ticket) avg_ticket
-                        from data
-                        where 1=1 
-                        {where_cohort}
-                        group by
-                            date,
-                            product                                       
-                                    
-                        UNION ALL
-                        
-                        select 
-                            date,
-                            'ALL_ACTIVE' segment,
-                            product,
-                            sum(avg_ticket) avg_ticket
-                        from data
-                        where 1=1 
-                            and segment <> 'inactive'
-                            {where_cohort} 
-                        group by
-                            date,
-                            product                                       
-                    ) x   
-                    where segment = '{segment}'                                 
-                ) y
-            """,conn)
-
-        return dfg
\ No newline at end of file
+
+    @timed('datalayer.share_table')
+    def share_table(self):
+
+        # every segment x cohort selection in one grouped pass, instead of one SQL query per selection
+        with self._share_lock:
+            if self._share is None:
+                table = self.from_bundle('share')
+                if table is not None:
+                    # bundles hold ShareTable.frame, already in slice order
+                    self._share = ShareTable(table, presorted=True)
+                else:
+                    table = self.cache.read('share', self.fingerprint)
+                    if table is None:
+                        dfu = self.unpivoted()
+                        parts = month_partitions(dfu, partition_count(len(dfu), self.workers))
+                        self._share = ShareTable(concat(run(share_months, [(p,) for p in parts], self.workers)))
+                        self.cache.write('share', self.fingerprint, self._share.frame)
+                    else:
+                        self._share = ShareTable(table)
+
+        return self._share
+
+    @timed('datalayer.load_with_share')
+    @memoized
+    def load_with_share(self, segment, cohort):
+
+        if self.on_demand:
+            # the backend's answer, in the dtypes of a share table slice
+            return self.query_backend().share(segment, as_month_key(cohort)).astype(self.share_dtypes())
+
+        return self.share_table().slice(as_month_key(cohort), segment)
+
+    def share_dtypes(self):
+        # the share table's categoricals: every segment with the rollups, every product
+        dfu = self.unpivoted()
+        segments = sorted(set(segment_rollups) | set(dfu['segment'].cat.categories))
+        return {'segment': pd.CategoricalDtype(segments), 'product': pd.CategoricalDtype(dfu['product'].cat.categories)}
+
+    @timed('datalayer.query_with_share')
+    @memoized
+    def query_with_share(self, segment, cohort):
+        # the same selection computed on demand by the query backend; load_with_share reads it precomputed
+        return self.query_backend().share(segment, as_month_key(cohort))
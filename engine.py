@@ -0,0 +1,95 @@
+import itertools
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+
+from instrument import span
+
+
+class ReadWriteLock:
+
+    def __init__(self):
+        self._readers = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reading(self):
+
+        with self._cond:
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def writing(self):
+
+        with self._cond:
+            self._cond.wait_for(lambda: self._readers == 0)
+            yield
+
+
+class QueryEngine:
+
+    _ids = itertools.count()
+
+    def __init__(self, frame, table='data', indexes=(('date', 'segment', 'product', 'cohort'),)):
+
+        # a named shared-cache memory database lives as long as one connection to it is open,
+        # so the anchor connection owns the data and pooled connections serve the reads
+        self.uri = f"file:datalayer_{os.getpid()}_{next(self._ids)}?mode=memory&cache=shared"
+        self.table = table
+        self._anchor = self._connect()
+        self._pool = queue.LifoQueue()
+        self._lock = ReadWriteLock()
+
+        with span('engine.to_sql', rows=len(frame)):
+            frame.to_sql(table, self._anchor, index=False)
+        for columns in indexes:
+            self._anchor.execute(f"create index ix_{table}_{'_'.join(columns)} on {table} ({', '.join(columns)})")
+        self._anchor.execute(f"analyze {table}")
+        self._anchor.commit()
+
+    def _connect(self):
+        return sqlite3.connect(self.uri, uri=True, check_same_thread=False, cached_statements=256)
+
+    @contextmanager
+    def connection(self):
+
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def query(self, sql, params=None):
+        with span('engine.query'), self._lock.reading(), self.connection() as conn:
+            return pd.read_sql_query(sql, conn, params=params)
+
+    def replace_partition(self, column, values, frame):
+
+        values = list(values)
+        placeholders = ', '.join('?' * len(values))
+
+        with self._lock.writing():
+            self._anchor.execute(f"delete from {self.table} where {column} in ({placeholders})", values)
+            frame.to_sql(self.table, self._anchor, index=False, if_exists='append')
+            self._anchor.commit()
+
+    def close(self):
+
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+        self._anchor.close()
@@ -0,0 +1,97 @@
+import io
+import os
+
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
+
+from pipeline import month_label
+
+# rows per batch; an export holds one batch, and the writer's buffer, at a time
+EXPORT_CHUNK_ROWS = int(os.environ.get('DL_EXPORT_CHUNK_ROWS', '65536'))
+
+# format -> (content type, file extension)
+formats = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+
+def export_format(fmt):
+    if fmt not in formats:
+        raise ValueError(f"export format must be one of {sorted(formats)}, not {fmt!r}")
+    return fmt
+
+
+def export_schema(frame):
+
+    # fixed up front from the frame's dtypes, so every batch (and an empty export) has the same one:
+    # month keys go out as 'YYYY-MM', categoricals stay dictionary-encoded except in CSV
+    schema = pa.Schema.from_pandas(frame.iloc[:0], preserve_index=False)
+    for name in ('date', 'cohort'):
+        if name in schema.names:
+            schema = schema.set(schema.get_field_index(name), pa.field(name, pa.string()))
+
+    return schema
+
+
+def plain(schema):
+    # CSV has no dictionaries: those columns are written as their values
+    return pa.schema([pa.field(f.name, f.type.value_type) if pa.types.is_dictionary(f.type) else f for f in schema])
+
+
+def record_batches(chunks, schema):
+    for chunk in chunks:
+        labelled = chunk.assign(**{c: month_label(chunk[c]) for c in ('date', 'cohort') if c in chunk})
+        yield pa.RecordBatch.from_pandas(labelled, schema=schema, preserve_index=False)
+
+
+def write_batches(sink, fmt, schema, batches):
+
+    # sink is a binary file object; it is flushed but left open. Returns the rows written
+    rows = 0
+    if fmt == 'csv':
+        schema = plain(schema)
+        writer = pcsv.CSVWriter(sink, schema)
+    elif fmt == 'parquet':
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+
+    try:
+        for batch in batches:
+            writer.write_batch(batch.cast(schema) if fmt == 'csv' else batch)
+            rows += batch.num_rows
+    finally:
+        writer.close()
+
+    sink.flush()
+    return rows
+
+
+class ChunkedSink(io.RawIOBase):
+
+    # HTTP/1.1 chunked transfer encoding over a socket file: the length of the body is never known
+    # up front, so nothing has to be held back to send a Content-Length
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        # the Parquet writer asks where it is to record its row group offsets
+        return self.position
+
+    def write(self, data):
+        if len(data):
+            self.wfile.write(b'%x\r\n' % len(data) + bytes(data) + b'\r\n')
+            self.position += len(data)
+        return len(data)
+
+    def finish(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
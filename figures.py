@@ -0,0 +1,386 @@
+import base64
+import json
+import os
+
+import humanize
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io as pio
+
+from cache import ResultCache
+from instrument import span
+from pipeline import month_label
+
+FIGURE_CACHE_BYTES = 64 * 1024 * 1024
+
+color_scale = px.colors.qualitative.Bold
+
+product_colors = {
+    'acquiring': color_scale[0],
+    'banking': color_scale[1],
+    'infinitecard': color_scale[2],
+    'pixcredit': color_scale[3],
+    'smartcash': color_scale[4]
+}
+
+
+def displayed(frame):
+    # dates are stored as month keys and dimensions as categoricals; charts and tables get 'YYYY-MM' and plain strings
+    return frame.assign(**{
+        c: month_label(frame[c]) if c in ('date', 'cohort') else frame[c].astype(str)
+        for c in frame.columns if c in ('date', 'cohort') or isinstance(frame[c].dtype, pd.CategoricalDtype)
+    })
+
+
+def try_humanize(x):
+    try:
+        n = humanize.intword(int(x))
+        n = n.replace("thousand","k")
+        n = n.replace("million","M")
+        return n
+    except:
+        return ""
+
+
+def cohort_heatmap(cross_tab, metric):
+
+    cross_tab = cross_tab.set_axis(month_label(cross_tab.index), axis=0).set_axis(month_label(cross_tab.columns), axis=1)
+    text_matrix = cross_tab.map(try_humanize)
+
+    fig = px.imshow(
+        cross_tab,
+        color_continuous_scale= px.colors.diverging.Temps_r,
+        labels = dict(
+            x='Month',
+            y='Cohort',
+            color=metric
+        ),
+        # text_auto=True
+    )
+
+    fig.update_traces(
+        text=text_matrix.values,
+        texttemplate="%{text}",
+        textfont_size=10
+    )
+
+    fig.update_layout(
+        height=700,
+        margin=dict(l=0, r=0, b=0, t=0, pad=4),
+    )
+
+    return fig
+
+
+def retention_curves(curves, metric):
+
+    # one line per product: each month since registration against month 0 of the cohorts that reached it
+    fig = px.line(
+        curves,
+        x='months_since_register',
+        y='retention',
+        color='product',
+        color_discrete_map=product_colors,
+        markers=True,
+        hover_data=['cohorts', metric],
+        labels=dict(
+            months_since_register='Months since registration',
+            retention=f'{metric} vs month 0'
+        )
+    )
+
+    fig.update_layout(
+        height=450,
+        yaxis_tickformat='.0%',
+        margin=dict(l=0, r=0, b=0, t=30, pad=4),
+    )
+
+    return fig
+
+
+def retention_heatmap(matrix, metric):
+
+    matrix = matrix.set_axis(month_label(matrix.index), axis=0)
+    text_matrix = matrix.map(lambda x: '' if pd.isna(x) else f'{x:.0%}')
+
+    fig = px.imshow(
+        matrix,
+        color_continuous_scale=px.colors.diverging.Temps_r,
+        labels=dict(
+            x='Months since registration',
+            y='Cohort',
+            color=f'{metric} vs month 0'
+        ),
+    )
+
+    fig.update_traces(
+        text=text_matrix.values,
+        texttemplate="%{text}",
+        textfont_size=10
+    )
+
+    fig.update_layout(
+        height=600,
+        margin=dict(l=0, r=0, b=0, t=0, pad=4),
+    )
+
+    return fig
+
+
+def evolution(aux):
+
+    fig = px.scatter(
+        aux,
+        x="total_amount",
+        y="total_merchants",
+        animation_frame="date",
+        animation_group="segment",
+        size="avg_ticket",
+        text='segment' if aux.segment.nunique() > 1 else 'product',
+        color="product",
+        hover_name="segment",
+        log_x=True,
+        log_y=True,
+        size_max=55,
+        range_x=[0.1, aux['total_amount'].max() * 1.5 ],
+        range_y=[0.1, aux['total_merchants'].max() * 1.5],
+        color_discrete_map=product_colors
+    )
+    fig.update_layout(
+        height=400,
+        transition = { 'duration': 50_000 },
+        margin=dict(l=0, r=0, b=20, t=0, pad=4),
+    )
+    fig.update_traces(textfont=dict(size=10))
+
+    return fig
+
+
+def rank(aux):
+
+    fig = go.Figure()
+
+    # one pass over the selection, products in order of first appearance
+    for prod, aux_prod in aux.groupby('product', sort=False):
+
+        current_color = product_colors.get(prod, 'gray')
+
+        fig.add_trace(
+            go.Scatter(
+                x = aux_prod['date'] ,
+                y = list(aux_prod['rank']) ,
+                mode = 'lines+markers',
+                name = prod ,
+                text =  [f"{t:.2%}" for t in aux_prod['percent_avg_ticket']]  ,
+                textposition="top center" ,
+                marker = dict(size=20, color=current_color),
+                line=dict(color=current_color)
+            )
+        )
+
+    fig.update_layout(
+        height = 250,
+        yaxis=dict(autorange='reversed'),
+        margin=dict(l=0, r=0, b=20, t=0, pad=4),
+    )
+
+    return fig
+
+
+def share(aux):
+
+    fig = px.bar(
+        aux ,
+        x ='date',
+        y ='percent_avg_ticket',
+        range_y=[0,1],
+        barmode='relative',
+        color = 'product',
+        color_discrete_map=product_colors ,
+        text = 'percent_avg_ticket'
+    )
+
+    fig.update_layout(
+        height = 250,
+        margin=dict(l=0, r=0, b=20, t=0, pad=4),
+        yaxis_title=None,
+        yaxis=dict(
+           tickformat=".0%"  # Formats as percentage with no decimal places
+        ),
+        xaxis_title=None,
+    )
+
+    fig.update_traces(texttemplate='%{text:.1%}')
+
+    return fig
+
+
+# trace attributes holding data arrays; other numeric lists (ranges, tick values) are left alone
+array_keys = {'x', 'y', 'z', 'customdata', 'size', 'color'}
+
+_missing = object()
+
+
+def narrow(values):
+
+    # floats go to float32, integers to the smallest type plotly.js has a typed array for
+    if values.dtype.kind == 'f':
+        return values.astype('float32')
+    if values.dtype.kind in 'iu' and values.size:
+        for dtype in ('int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32'):
+            info = np.iinfo(dtype)
+            if values.min() >= info.min and values.max() <= info.max:
+                return values.astype(dtype)
+    if values.dtype.kind in 'iu':
+        # plotly.js has no 64-bit integer arrays; as doubles these are the numbers JSON would give it
+        return values.astype('float64')
+
+    return values
+
+
+def encode(values, shape=None):
+
+    spec = {'dtype': values.dtype.str.lstrip('<|='), 'bdata': base64.b64encode(values.tobytes()).decode()}
+    if shape is not None:
+        spec['shape'] = shape
+
+    return spec
+
+
+def compact_trace(trace):
+
+    for key, value in trace.items():
+        if isinstance(value, dict) and 'bdata' in value:
+            values = np.frombuffer(base64.b64decode(value['bdata']), dtype=value['dtype'])
+            trace[key] = encode(narrow(values), value.get('shape'))
+        elif isinstance(value, dict):
+            compact_trace(value)
+        elif key in array_keys and isinstance(value, list) and value and all(
+            isinstance(v, (int, float)) and not isinstance(v, bool) for v in value
+        ):
+            spec = encode(narrow(np.asarray(value)))
+            # short lists of small numbers are shorter as plain JSON
+            if len(json.dumps(spec, separators=(',', ':'))) < len(json.dumps(value, separators=(',', ':'))):
+                trace[key] = spec
+
+    return trace
+
+
+def same(a, b):
+
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same(a[k], b[k]) for k in a)
+    try:
+        return bool(a == b)
+    except ValueError:
+        return False
+
+
+def shared_keys(dicts):
+
+    # keys every dict has with the same value; nested dicts are compared key by key,
+    # typed arrays as a whole
+    shared = {}
+    for key in dicts[0]:
+        values = [d.get(key, _missing) for d in dicts]
+        if any(v is _missing for v in values):
+            continue
+        if all(isinstance(v, dict) and 'bdata' not in v for v in values):
+            nested = shared_keys(values)
+            if nested:
+                shared[key] = nested
+        elif all(same(values[0], v) for v in values[1:]):
+            shared[key] = True
+
+    return shared
+
+
+def strip(trace, shared):
+
+    for key, nested in shared.items():
+        if nested is True:
+            trace.pop(key, None)
+        else:
+            strip(trace[key], nested)
+            if not trace[key]:
+                trace.pop(key)
+
+
+def dedup_frames(spec):
+
+    # animation frames are merged into the traces they name, so anything a trace has in common
+    # with every frame (colors, templates, ...) only needs to be sent once, on the trace itself
+    frames = spec.get('frames') or []
+    names = [t.get('name') for t in spec['data']]
+    if not frames or len(set(names)) != len(names):
+        return spec
+
+    for trace in spec['data']:
+        in_frames = [t for f in frames for t in f.get('data', []) if t.get('name') == trace.get('name')]
+        if len(in_frames) != len(frames):
+            continue
+        shared = shared_keys([trace] + in_frames)
+        shared.pop('type', None)
+        shared.pop('name', None)
+        for t in in_frames:
+            strip(t, shared)
+
+    return spec
+
+
+def compact(fig):
+
+    spec = fig.to_dict()
+    for trace in spec['data']:
+        compact_trace(trace)
+    for frame in spec.get('frames') or []:
+        for trace in frame.get('data', []):
+            compact_trace(trace)
+
+    return go.Figure(dedup_frames(spec))
+
+
+class CachedFigure:
+
+    def __init__(self, figure):
+        self.figure = figure
+        # what the browser receives, which is also about what the figure holds
+        self.nbytes = len(pio.to_json(figure, validate=False))
+
+
+class FigureCache:
+
+    def __init__(self, max_bytes=FIGURE_CACHE_BYTES, compact=True):
+        self.compact = compact
+        self.results = ResultCache(max_bytes)
+
+    def key(self, chart, metric=None, segment=None, cohort=None, fingerprint=None, product=None):
+        return (chart, metric, segment, cohort, product, fingerprint, self.compact)
+
+    def contains(self, chart, **selection):
+        return self.key(chart, **selection) in self.results
+
+    def get(self, chart, build, **selection):
+
+        key = self.key(chart, **selection)
+
+        def compute():
+            with span('figures.build', chart=chart):
+                figure = build()
+                if self.compact:
+                    figure = compact(figure)
+                return CachedFigure(figure)
+
+        return self.results.get_or_compute(key, compute).figure
+
+    def stats(self):
+        return self.results.stats()
+
+    def clear(self):
+        self.results.clear()
+
+
+# figures are shared by every session of the process; DL_FIGURE_COMPACT=0 sends them uncompacted
+figure_cache = FigureCache(compact=os.environ.get('DL_FIGURE_COMPACT', '1') != '0')
@@ -0,0 +1,126 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger('datalayer.profile')
+
+MAX_RECORDS = 2000
+
+
+class _State:
+    enabled = False
+    memory = False
+    log_path = None
+
+
+_state = _State()
+_records = deque(maxlen=MAX_RECORDS)
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def enable(memory=True, log_path=None):
+
+    _state.memory = memory
+    _state.log_path = log_path
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _state.enabled = True
+
+
+def disable():
+
+    _state.enabled = False
+    if _state.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def enabled():
+    return _state.enabled
+
+
+def records():
+    with _lock:
+        return list(_records)
+
+
+def clear():
+    with _lock:
+        _records.clear()
+
+
+def _emit(record):
+
+    with _lock:
+        _records.append(record)
+
+    line = json.dumps(record, default=str)
+    logger.debug(line)
+    if _state.log_path:
+        with _lock, open(_state.log_path, 'a') as f:
+            f.write(line + '\n')
+
+
+@contextmanager
+def span(name, **tags):
+
+    if not _state.enabled:
+        yield
+        return
+
+    depth = getattr(_local, 'depth', 0)
+    _local.depth = depth + 1
+
+    memory = _state.memory and tracemalloc.is_tracing()
+    if memory:
+        allocated = tracemalloc.get_traced_memory()[0]
+        # peaks are process-wide, so only the outermost span of a thread resets them
+        if depth == 0:
+            tracemalloc.reset_peak()
+
+    started, wall, cpu = time.time(), time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        record = {
+            'name': name,
+            'depth': depth,
+            'thread': threading.current_thread().name,
+            'start': started,
+            'wall_ms': (time.perf_counter() - wall) * 1000,
+            'cpu_ms': (time.thread_time() - cpu) * 1000,
+        }
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            record['alloc_mb'] = (current - allocated) / 2 ** 20
+            record['peak_mb'] = peak / 2 ** 20
+        record.update(tags)
+
+        _local.depth = depth
+        _emit(record)
+
+
+def timed(name):
+
+    def decorator(fn):
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _state.enabled:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+if os.environ.get('DL_PROFILE', '') not in ('', '0'):
+    enable(memory=os.environ.get('DL_PROFILE_MEMORY', '1') != '0', log_path=os.environ.get('DL_PROFILE_LOG'))
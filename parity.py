@@ -0,0 +1,87 @@
+import argparse
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from backends import backends
+from datalayer import CACHE_DIR, DATA_PATH, META_PATH, DataLayer, segment_rollups
+from pipeline import ALL_COHORT
+
+
+def same_frame(a, b):
+    try:
+        pd.testing.assert_frame_equal(a, b)
+        return True
+    except AssertionError:
+        return False
+
+
+def precomputed(dl, method, args):
+
+    # what the precomputed tables hold for the same query, in the backends' dtypes and order
+    if method == 'query_with_share':
+        return dl.load_with_share(*args).astype({'segment': object, 'product': object})
+
+    totals = dl.window_totals(*args).astype({'segment': str, 'product': str}).astype({'segment': object, 'product': object})
+    return totals.sort_values(['segment', 'product'], kind='stable', ignore_index=True)
+
+
+def check(data_path=DATA_PATH, meta_path=META_PATH, cache_dir=CACHE_DIR, names=None, windows=(1, 3, 6, 12)):
+
+    # every backend answers every segment x cohort share selection and a few trailing windows
+    # through the DataLayer query methods; each answer must equal the precomputed one
+    names = list(names or backends)
+    reference = DataLayer(data_path, meta_path, cache_dir, bundle_dir=None)
+    # the precomputed tables, even with DL_BACKEND set
+    reference.on_demand = False
+    dfu = reference.unpivoted()
+
+    segments = list(segment_rollups) + sorted(str(s) for s in dfu['segment'].unique())
+    cohorts = [ALL_COHORT] + sorted(int(c) for c in dfu['cohort'].unique() if c != ALL_COHORT)
+    queries = [('query_with_share', (s, c)) for s in segments for c in cohorts]
+    queries += [('query_totals', (months,)) for months in windows]
+
+    expected = [precomputed(reference, method, args) for method, args in queries]
+
+    timings, problems = {}, []
+    for name in names:
+        dl = DataLayer(data_path, meta_path, cache_dir, bundle_dir=None, backend=name)
+        dl.unpivoted()
+
+        start = time.perf_counter()
+        dl.query_backend()
+        built = time.perf_counter()
+        results = [getattr(dl, method)(*args) for method, args in queries]
+        timings[name] = {'build_s': built - start, 'queries_s': time.perf_counter() - built}
+
+        for (method, args), got, want in zip(queries, results, expected):
+            if not same_frame(got, want):
+                problems.append(f"{name}: {method}{args} differs from the precomputed result")
+
+    return timings, problems, len(queries)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Check that every query backend returns the precomputed results, and time them')
+    parser.add_argument('--data', default=DATA_PATH)
+    parser.add_argument('--meta', default=META_PATH)
+    parser.add_argument('--backend', nargs='*', choices=sorted(backends), help='only check these (default: all)')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='parity-') as cache_dir:
+        timings, problems, queries = check(args.data, args.meta, cache_dir, args.backend)
+
+    for name, timing in timings.items():
+        print(f"{name:8} build {timing['build_s']:.3f}s  {queries} queries {timing['queries_s']:.3f}s")
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    print('ok' if not problems else f"{len(problems)} mismatches")
+
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,481 @@
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cache import arrow_table
+from instrument import timed
+from rollup import rollup
+
+# bump whenever the unpivoted output or a bundled array changes shape or semantics, so cached
+# artifacts get rebuilt
+PIPELINE_VERSION = 4
+
+measure_columns = ['total_amount', 'total_merchants', 'avg_ticket']
+
+# month key of the cohort='ALL' rollup rows; sorts after every real month, as 'ALL' did after 'YYYY-MM'
+ALL_COHORT = np.iinfo('int32').max
+
+# the cohort='ALL' rows sum every cohort, the rollup rows included
+cohort_rollups = {'cohort': {ALL_COHORT: lambda cohort: True}}
+
+
+def read_source(path):
+
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    if path.endswith(('.arrow', '.feather')):
+        return pd.read_feather(path)
+
+    return pd.read_pickle(path)
+
+
+def write_source(df, path):
+
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index=False)
+    elif path.endswith(('.arrow', '.feather')):
+        df.to_feather(path)
+    else:
+        df.to_pickle(path)
+
+
+def read_meta(path):
+    with open(path) as f:
+        return meta_frame(json.load(f))
+
+
+def meta_frame(meta):
+    # column -> its meta_* fields, as meta.json holds them, to one row per column
+    return pd.DataFrame.from_dict(meta, orient='index').reset_index().rename(columns={'index':'column'})
+
+
+def month_key(values):
+    # datetimes -> year * 12 + month - 1, the int32 key dates and cohorts are stored as
+    dates = pd.DatetimeIndex(values)
+    return (dates.year * 12 + dates.month - 1).to_numpy().astype('int32')
+
+
+def month_start(keys):
+    return pd.DatetimeIndex((np.asarray(keys, dtype='int64') - 1970 * 12).astype('datetime64[M]').astype('datetime64[ns]'))
+
+
+def month_label(keys):
+
+    # month keys are formatted as 'YYYY-MM' only for display; the rollup sentinel shows as 'ALL'
+    if isinstance(keys, str):
+        return keys
+    if np.ndim(keys) == 0:
+        key = int(keys)
+        return 'ALL' if key == ALL_COHORT else f"{key // 12:04d}-{key % 12 + 1:02d}"
+
+    uniques, inverse = np.unique(np.asarray(keys), return_inverse=True)
+    labels = np.array([month_label(k) for k in uniques], dtype=object)[inverse.ravel()]
+
+    if isinstance(keys, pd.Series):
+        return pd.Series(labels, index=keys.index, name=keys.name)
+    if isinstance(keys, pd.Index):
+        return pd.Index(labels, name=keys.name)
+    return labels
+
+
+def as_month_key(value):
+
+    # selectors accept a month key, 'YYYY-MM', a date or 'ALL'
+    if isinstance(value, str):
+        if value == 'ALL':
+            return ALL_COHORT
+        matched = re.fullmatch(r'(\d{4})-(\d{2})', value)
+        if matched is None or not 1 <= int(matched[2]) <= 12:
+            raise ValueError(f"month must be 'YYYY-MM' or 'ALL', not {value!r}")
+        return int(matched[1]) * 12 + int(matched[2]) - 1
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+
+    return int(month_key([value])[0])
+
+
+def dtype_schema(meta, float_dtype='float64'):
+
+    # column -> storage dtype: time dimensions become month keys, discrete ones dictionary-encoded
+    # categoricals, raw metrics the narrowest integer that fits and calculated ones float_dtype
+    schema = {'product': 'category', 'metric': 'category'}
+
+    for column, cls, kind, calculated in zip(meta['column'], meta['meta_class'], meta['meta_kind'], meta['meta_calculation']):
+        if cls == 'dimension':
+            schema[column] = {'time': 'month', 'discrete': 'category'}.get(kind, float_dtype)
+        else:
+            schema[column] = float_dtype if calculated else 'integer'
+
+    schema.update({f"avg_{m}": float_dtype for m in avg_columns(meta)})
+    schema['avg_ticket'] = float_dtype
+
+    return schema
+
+
+def apply_schema(df, schema):
+
+    df = df.copy(deep=False)
+
+    for column in df.columns:
+        dtype, values = schema.get(column), df[column]
+
+        if dtype is None:
+            continue
+        elif dtype == 'month':
+            if not pd.api.types.is_integer_dtype(values):
+                values = month_key(values)
+            df[column] = np.asarray(values, dtype='int32')
+        elif dtype == 'integer':
+            if pd.api.types.is_integer_dtype(values):
+                info = np.iinfo('int32')
+                fits = len(values) == 0 or (values.min() >= info.min and values.max() <= info.max)
+                df[column] = values.astype('int32' if fits else 'int64')
+        elif dtype == 'category':
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                df[column] = values.astype('category')
+        elif values.dtype != dtype:
+            df[column] = values.astype(dtype)
+
+    return df
+
+
+def source_frame(df, schema):
+
+    # undoes apply_schema, so a frame written back as source keeps its datetimes, strings and int64s
+    df = df.copy(deep=False)
+
+    for column in df.columns:
+        dtype = schema.get(column)
+        if dtype == 'month':
+            df[column] = month_start(df[column])
+        elif dtype == 'category':
+            df[column] = df[column].astype(object)
+        elif dtype == 'integer':
+            df[column] = df[column].astype('int64')
+
+    return df
+
+
+def int_div(a, b):
+
+    # SQL division: integers truncate toward zero, anything REAL divides exactly, and dividing
+    # by zero gives NULL (NaN here, which makes the result float)
+    a, b = np.asarray(a), np.asarray(b)
+    zero = b == 0
+    divisor = np.where(zero, 1, b)
+
+    if a.dtype.kind in 'iu' and b.dtype.kind in 'iu':
+        q = np.abs(a) // np.abs(divisor) * np.sign(a) * np.sign(divisor)
+    else:
+        q = a / divisor
+
+    return np.where(zero, np.nan, q) if zero.any() else q
+
+
+def concat(frames):
+
+    # pd.concat turns categoricals with different categories into object columns,
+    # so they are first widened to the sorted union of every frame's categories
+    frames = [f for f in frames if f is not None]
+    for column in frames[0].columns:
+        dtypes = [f[column].dtype for f in frames if column in f]
+        if all(d == dtypes[0] for d in dtypes):
+            continue
+        if any(isinstance(d, pd.CategoricalDtype) for d in dtypes):
+            categories = set()
+            for f in frames:
+                values = f[column]
+                categories.update(values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) else values.unique())
+            dtype = pd.CategoricalDtype(sorted(categories))
+            frames = [f.assign(**{column: f[column].astype(dtype)}) for f in frames]
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def avg_columns(meta):
+
+    # avg_<money> = <money> / <unit column of the same product>, for every non-calculated money column
+    metrics = meta[ meta['meta_class'] == 'metric' ]
+    units = metrics[ metrics['meta_kind'] == 'unit' ].set_index('meta_product')['column']
+    money = metrics[ (metrics['meta_kind'] == 'money') & (metrics['meta_calculation'] == False) ]
+
+    return {m: units[p] for m, p in zip(money['column'], money['meta_product']) if p in units}
+
+
+def reshape_plan(meta):
+
+    # product -> the single money, unit and avg column feeding each measure; products missing
+    # one of them are left out, as the inner merges of the melted frames used to do
+    metrics = meta[ meta['meta_class'] == 'metric' ]
+    sources = {
+        'total_amount': metrics[ (metrics['meta_kind'] == 'money') & (metrics['meta_active'] == True) & (metrics['meta_calculation'] == False) ],
+        'total_merchants': metrics[ metrics['meta_kind'] == 'unit' ],
+        'avg_ticket': metrics[ (metrics['meta_kind'] == 'money') & (metrics['meta_active'] == True) & (metrics['meta_calculation'] == True) ],
+    }
+
+    plan = None
+    for measure, rows in sources.items():
+        duplicated = rows['meta_product'].duplicated(keep=False)
+        if duplicated.any():
+            raise ValueError(f"meta maps more than one {measure} column to a product: {list(rows[duplicated]['column'])}")
+
+        column = rows.set_index('meta_product')['column'].rename(measure)
+        plan = column.to_frame() if plan is None else plan.join(column, how='inner')
+
+    return plan
+
+
+@timed('pipeline.widen')
+def widen(df, meta, float_dtype='float64'):
+
+    schema = dtype_schema(meta, float_dtype)
+    dfw = apply_schema(df, schema)
+
+    for money_col, qty_col in avg_columns(meta).items():
+        dfw[ f"avg_{money_col}" ] = dfw[money_col] / dfw[qty_col]
+
+    # dates are first-of-month, so the day count comes straight from the month keys
+    days = (month_start(dfw['date']) - month_start(dfw['cohort'])).days
+    dfw['months_since_register'] = np.asarray(days // 30, dtype='int16')
+
+    return apply_schema(dfw, {c: t for c, t in schema.items() if c.startswith('avg_')})
+
+
+def tile(values, reps):
+
+    # categoricals are tiled through their codes so the dictionary encoding survives
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return pd.Categorical.from_codes(np.tile(values.cat.codes.to_numpy(), reps), dtype=values.dtype)
+    return np.tile(values.to_numpy(), reps)
+
+
+@timed('pipeline.unpivot_base')
+def unpivot_base(dfw, meta):
+
+    plan = reshape_plan(meta).sort_index()
+    id_vars = list(meta[ meta['meta_class'] =='dimension' ]['column'])
+    n = len(dfw)
+
+    # product-major blocks, the layout melt produced: block i holds every source row for product i
+    dfu = pd.DataFrame({c: tile(dfw[c], len(plan)) for c in id_vars})
+    dfu['product'] = pd.Categorical.from_codes(np.repeat(np.arange(len(plan)), n), categories=list(plan.index))
+
+    for measure in measure_columns:
+        values = dfw[list(plan[measure])]
+        dfu[measure] = values.to_numpy(dtype=np.result_type(*values.dtypes)).ravel(order='F')
+
+    # categoricals have no 0 to fill with; their missing values stay missing
+    return dfu.fillna({c: 0 for c in dfu.columns if not isinstance(dfu[c].dtype, pd.CategoricalDtype)})
+
+
+def cohort_sums(dfu):
+    # per (date, segment, product) sums over every cohort, labelled ALL_COHORT; sums of sums are
+    # exact, so sums of partial chunks fold by going through here again
+    return rollup(dfu, ['date', 'cohort', 'segment', 'product'], ['total_amount', 'total_merchants'], cohort_rollups, sets=[('cohort',)])
+
+
+@timed('pipeline.rollup_cohorts')
+def rollup_cohorts(dfu):
+
+    sums = cohort_sums(dfu).sort_values(['date', 'segment', 'product'], kind='stable', ignore_index=True)
+
+    # avg_ticket divides the sums the way SQL did: integer division, NaN for no merchants
+    rollup = pd.DataFrame({
+        'date': sums['date'],
+        'cohort': sums['cohort'],
+        'segment': sums['segment'],
+        'months_since_register': np.nan,
+        'product': sums['product'],
+        'total_amount': sums['total_amount'],
+        'total_merchants': sums['total_merchants'],
+        'avg_ticket': int_div(sums['total_amount'].to_numpy(), sums['total_merchants'].to_numpy()),
+    })
+
+    # back to the dtypes of the base rows; the merchant sums stay int64 so they cannot overflow
+    dtypes = {'date': 'int32', 'cohort': 'int32', 'months_since_register': 'float64', 'avg_ticket': 'float64'}
+    dtypes.update({c: dfu[c].dtype for c in ('avg_ticket',) if c in dfu})
+
+    return rollup.astype(dtypes)
+
+
+def unpivot(dfw, meta):
+
+    dfu = unpivot_base(dfw, meta)
+
+    return canonical_order(concat([dfu, rollup_cohorts(dfu)]))
+
+
+def canonical_order(dfu):
+    # date-major so every month is one contiguous partition; the ALL_COHORT sentinel sorts after the
+    # cohort months, and categoricals have sorted categories so they order like the strings did
+    return dfu.sort_values(['date', 'cohort', 'segment', 'product'], kind='stable', ignore_index=True)
+
+
+def splice_months(dfu, part):
+
+    # both frames are in canonical order, so each month is a contiguous block found by binary search
+    pieces, pos = [], 0
+    for month, block in part.groupby('date', sort=True):
+        lo = dfu['date'].searchsorted(month, 'left')
+        hi = dfu['date'].searchsorted(month, 'right')
+        pieces += [dfu.iloc[pos:lo], block]
+        pos = hi
+    pieces.append(dfu.iloc[pos:])
+
+    return concat(pieces)
+
+
+# peak memory of one streamed chunk over what stream_chunk_rows samples (its source rows plus their
+# unpivoted rows): the unpivot_base output with its fillna and canonical_order copies, then the
+# plain-string columns and Arrow table it is spilled as. Measured at 3.3-3.7 from 2k to 100k source
+# rows a chunk, so 4 keeps a chunk under max_memory
+STREAM_PEAK_FACTOR = 4
+
+# the spilled chunks keep segment and product as plain strings: IPC files cannot change a
+# dictionary between batches, and each chunk has its own categories
+unpivoted_schema = pa.schema([
+    ('date', pa.int32()),
+    ('cohort', pa.int32()),
+    ('segment', pa.string()),
+    ('months_since_register', pa.float64()),
+    ('product', pa.string()),
+    ('total_amount', pa.int64()),
+    ('total_merchants', pa.int64()),
+    ('avg_ticket', pa.float64()),
+])
+
+
+def iter_source(path, chunk_rows):
+
+    if path.endswith('.parquet'):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+
+    elif path.endswith(('.arrow', '.feather')):
+        with pa.memory_map(path, 'r') as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                for offset in range(0, batch.num_rows, chunk_rows):
+                    yield batch.slice(offset, chunk_rows).to_pandas()
+
+    else:
+        raise ValueError(f"streaming needs a Parquet or Arrow IPC source, got {path}")
+
+
+def stream_chunk_rows(path, meta, max_memory):
+
+    sample = next(iter_source(path, 1000))
+    out = unpivot_base(widen(sample, meta), meta)
+    per_row = (sample.memory_usage(deep=True).sum() + out.memory_usage(deep=True).sum()) / max(len(sample), 1)
+
+    return max(1, int(max_memory // (per_row * STREAM_PEAK_FACTOR)))
+
+
+def stored_dtypes(schema, categories, bounds):
+
+    # the dtypes apply_schema(schema) gives the whole table, fixed before it is written one month at a
+    # time: every category seen in any chunk, and the integer width that fits every chunk's values
+    info = np.iinfo('int32')
+    dtypes = {c: pd.CategoricalDtype(sorted(values)) for c, values in categories.items()}
+    dtypes.update({c: 'int32' if lo >= info.min and hi <= info.max else 'int64' for c, (lo, hi) in bounds.items() if schema.get(c) == 'integer'})
+
+    return dtypes
+
+
+def observe(dfu, categories, bounds):
+    # folds a chunk's categories and integer ranges into the running ones
+    for column in ('segment', 'product'):
+        values = dfu[column]
+        categories.setdefault(column, set()).update(values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) else values.unique())
+    for column in ('total_amount', 'total_merchants'):
+        if len(dfu) and pd.api.types.is_integer_dtype(dfu[column]):
+            lo, hi = bounds.get(column, (dfu[column].min(), dfu[column].max()))
+            bounds[column] = (min(lo, dfu[column].min()), max(hi, dfu[column].max()))
+
+
+@timed('pipeline.stream_unpivot')
+def stream_unpivot(path, destination, meta, max_memory=256 * 1024 * 1024, schema=None):
+
+    # base rows only depend on their own source row, so each chunk is unpivoted on its own and
+    # spilled next to destination in canonical order; the ALL rollup only needs per (date, segment,
+    # product) sums, which are folded chunk by chunk. Each month is then gathered from every spilled
+    # chunk, joined by its rollup rows and copied into a memory-mapped file per column. Those are
+    # written out as one record batch in canonical order and in the dtypes apply_schema(schema)
+    # gives, so the file maps into a frame as it is. At most a chunk or a month is held at a time
+    schema = schema or dtype_schema(meta)
+    chunk_rows = stream_chunk_rows(path, meta, max_memory)
+    spill = f"{destination}.spill"
+    partials, runs, categories, bounds, columns = None, [], {}, {}, {}
+    stats = {'chunk_rows': chunk_rows, 'chunks': 0, 'rows_in': 0, 'rows_out': 0}
+
+    try:
+        with pa.OSFile(spill, 'wb') as sink, pa.ipc.new_file(sink, unpivoted_schema) as writer:
+
+            for chunk in iter_source(path, chunk_rows):
+                dfu = canonical_order(unpivot_base(widen(chunk, meta), meta))
+                writer.write_table(pa.Table.from_pandas(dfu.astype({'segment': object, 'product': object}), schema=unpivoted_schema, preserve_index=False))
+
+                # where each month's rows start and stop in this chunk
+                months, starts = np.unique(dfu['date'].to_numpy(), return_index=True)
+                runs.append(dict(zip(months.tolist(), zip(starts.tolist(), np.append(starts[1:], len(dfu)).tolist()))))
+
+                observe(dfu, categories, bounds)
+                partial = cohort_sums(dfu)
+                partials = partial if partials is None else cohort_sums(concat([partials, partial]))
+
+                stats['chunks'] += 1
+                stats['rows_in'] += len(chunk)
+
+        rollups = rollup_cohorts(partials) if partials is not None else None
+        if rollups is not None:
+            observe(rollups, categories, bounds)
+        dtypes = stored_dtypes(schema, categories, bounds)
+        layout = apply_schema(unpivoted_schema.empty_table().to_pandas(), schema).astype(dtypes)
+        rows = sum(hi - lo for run in runs for lo, hi in run.values()) + (len(rollups) if rollups is not None else 0)
+
+        def stored(values):
+            # what a column keeps on disk: categoricals as their codes
+            return values.cat.codes.to_numpy() if isinstance(values.dtype, pd.CategoricalDtype) else values.to_numpy()
+
+        if rows:
+            columns = {c: np.memmap(f"{spill}.{i}", dtype=stored(layout[c]).dtype, mode='w+', shape=(rows,)) for i, c in enumerate(layout.columns)}
+
+        with pa.memory_map(spill, 'r') as source:
+            reader, position = pa.ipc.open_file(source), 0
+
+            for month in sorted(set().union(*runs)):
+                pieces = [reader.get_batch(i).slice(lo, hi - lo) for i, run in enumerate(runs) if month in run for lo, hi in [run[month]]]
+                base = pa.Table.from_batches(pieces, schema=unpivoted_schema).to_pandas()
+                rolled = rollups.iloc[rollups['date'].searchsorted(month, 'left'):rollups['date'].searchsorted(month, 'right')]
+
+                # stable, so rows with equal keys keep source order, as in canonical_order of the whole table
+                block = apply_schema(canonical_order(concat([base, rolled])), schema).astype(dtypes)
+                for c, values in columns.items():
+                    values[position:position + len(block)] = stored(block[c])
+                position += len(block)
+
+        arrays = [
+            pa.DictionaryArray.from_arrays(pa.array(columns[c]), pa.array(layout[c].cat.categories.to_numpy()))
+            if isinstance(layout[c].dtype, pd.CategoricalDtype) else pa.array(columns[c])
+            for c in layout.columns
+        ] if rows else None
+        table = arrow_table(layout) if arrays is None else pa.Table.from_arrays(arrays, schema=arrow_table(layout).schema)
+
+        # the mapped columns go to disk page by page, not through memory
+        with pa.OSFile(destination, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        stats['rows_out'] = rows
+
+    finally:
+        columns.clear()
+        for leftover in [spill] + [f"{spill}.{i}" for i in range(len(unpivoted_schema))]:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    return stats
@@ -0,0 +1,58 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from instrument import span
+
+# below this many rows a partition costs more to ship to a worker process than to compute in place
+MIN_PARTITION_ROWS = 100_000
+
+# binning a metric into the cohort cube is far cheaper per row than unpivoting it, so a cube
+# slice needs this many row x metric cells to pay for a worker
+MIN_CUBE_CELLS = 50_000_000
+
+
+def worker_count(workers=None):
+    # None reads DL_WORKERS (default 1, everything in process); 0 or less means one per core
+    if workers is None:
+        workers = int(os.environ.get('DL_WORKERS', '1'))
+    return workers if workers > 0 else os.cpu_count() or 1
+
+
+def partition_count(rows, workers, min_rows=None):
+    return max(1, min(workers, rows // (min_rows or MIN_PARTITION_ROWS)))
+
+
+def month_partitions(frame, parts):
+
+    # contiguous runs of whole months with about the same number of rows each; every stage
+    # that is partitioned this way only ever combines rows of the same month
+    if parts <= 1:
+        return [frame]
+
+    counts = frame['date'].value_counts().sort_index()
+    cumulative = counts.cumsum().to_numpy()
+    cuts = np.searchsorted(cumulative, np.arange(1, parts) * cumulative[-1] / parts) + 1
+    groups = [g for g in np.split(counts.index.to_numpy(), np.unique(cuts)) if len(g)]
+
+    return [frame[ frame['date'].isin(g) ] for g in groups]
+
+
+def chunks(items, parts):
+    # items split into at most parts contiguous, non-empty runs
+    return [list(c) for c in np.array_split(np.asarray(items, dtype=object), min(max(parts, 1), len(items))) if len(c)]
+
+
+def run(task, parts, workers):
+
+    # parts are argument tuples for task; results come back in the order of parts, whatever
+    # order the workers finish in, so merging them is deterministic. Workers are spawned rather
+    # than forked: the data layer may be called from a thread while others hold locks.
+    with span('precompute.run', task=task.__name__, parts=len(parts), workers=min(workers, len(parts))):
+        if workers <= 1 or len(parts) <= 1:
+            return [task(*args) for args in parts]
+
+        with ProcessPoolExecutor(min(workers, len(parts)), mp_context=multiprocessing.get_context('spawn')) as pool:
+            return list(pool.map(task, *zip(*parts)))
@@ -0,0 +1,73 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from instrument import span
+
+logger = logging.getLogger('datalayer.prefetch')
+
+# threads shared by every session of the process; prefetching only ever uses what they leave idle
+PREFETCH_WORKERS = int(os.environ.get('DL_PREFETCH_WORKERS', '2'))
+
+
+class Prefetcher:
+
+    def __init__(self, workers=PREFETCH_WORKERS):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max(workers, 1), thread_name_prefix='prefetch')
+        self.submitted = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def schedule(self, owner, jobs):
+
+        # jobs are (name, callable) pairs, most likely next first. Whatever the owner (one
+        # session) still has queued is stale once it moves on, so it is cancelled; a job already
+        # running finishes, since it only fills caches the new selection may want anyway
+        with self._lock:
+            self._cancel(owner)
+            # owners whose work all finished (sessions that went away) are forgotten
+            self._pending = {o: futures for o, futures in self._pending.items() if not all(f.done() for f in futures)}
+            if self.workers < 1:
+                return
+            self._pending[owner] = [self.pool.submit(self._run, name, job) for name, job in jobs]
+            self.submitted += len(jobs)
+
+    def cancel(self, owner):
+        with self._lock:
+            self._cancel(owner)
+
+    def _cancel(self, owner):
+        for future in self._pending.pop(owner, ()):
+            if future.cancel():
+                self.cancelled += 1
+
+    def _run(self, name, job):
+
+        try:
+            with span('prefetch.job', job=name):
+                job()
+        except Exception:
+            # a failed prefetch only costs the foreground a cache miss
+            logger.exception("prefetch %s failed", name)
+            with self._lock:
+                self.failed += 1
+        else:
+            with self._lock:
+                self.completed += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers, 'submitted': self.submitted, 'completed': self.completed,
+                'cancelled': self.cancelled, 'failed': self.failed,
+                'queued': sum(not f.done() for futures in self._pending.values() for f in futures),
+            }
+
+
+# shared by every session of the process; DL_PREFETCH_WORKERS=0 turns prefetching off
+prefetcher = Prefetcher()
@@ -0,0 +1,227 @@
+import numpy as np
+import pandas as pd
+
+from cube import grown
+from pipeline import ALL_COHORT
+
+retention_metrics = ['total_merchants', 'total_amount']
+
+
+def accumulate(values, cohorts, dates, first=0, sums=None):
+
+    # adds the cells of the date columns from first on to sums (cohorts, totals and month 0 bases per
+    # age, metric x segment x product x age), widened to the oldest age observed. One date at a time:
+    # there every cohort is at a different age, so each age is added to once
+    age = dates[first:].to_numpy(dtype='int64')[None, :] - cohorts.to_numpy(dtype='int64')[:, None]
+    observed = ~np.isnan(values[..., first:]).all(axis=(0, 1, 2)) & (age >= 0)
+    old = sums[0].shape[-1] if sums is not None else 0
+    n_age = max(old, int(age[observed].max()) + 1 if observed.any() else 0)
+
+    counts, totals, bases = (np.zeros(values.shape[:3] + (n_age,), dtype=dtype) for dtype in ('int64', 'float64', 'float64'))
+    if sums is not None:
+        for total, before in zip((counts, totals, bases), sums):
+            total[..., :old] = before
+
+    # a cohort's month 0 is its cell at its own month
+    month_0 = dates.get_indexer(cohorts)
+    month_0 = np.where(month_0 >= 0, values[..., np.arange(len(cohorts)), month_0], np.nan)
+
+    for j in range(first, len(dates)):
+        rows = np.flatnonzero(age[:, j - first] >= 0)
+        ages = age[rows, j - first]
+        cells = values[..., rows, j]
+        reached = ~np.isnan(cells)
+        counts[..., ages] += reached
+        totals[..., ages] += np.where(reached, cells, 0)
+        bases[..., ages] += np.where(reached, month_0[..., rows], 0)
+
+    return counts, totals, bases
+
+
+class RetentionCube:
+
+    def __init__(self, values, metrics, segments, products, cohorts, dates, rollups=(), buffer=None, sums=None):
+
+        # values is a dense metric x segment x product x cohort x date array, NaN where a cohort has no
+        # rows that month; a cell's age (whole months since registration) is the calendar month
+        # difference of its month keys. Laid out by date, not age, so a new month is one more column
+        # of a buffer that may hold room for later ones (see append)
+        self.values = values
+        self._buffer = values if buffer is None else buffer
+        self.values.flags.writeable = False
+        self.metrics = list(metrics)
+        self.segments = list(segments)
+        self.products = list(products)
+        self.cohorts = pd.Index(cohorts, name='cohort')
+        self.dates = pd.Index(dates, name='date')
+        self.rollups = list(rollups)
+
+        self._metric_pos = {m: i for i, m in enumerate(self.metrics)}
+        self._segment_pos = {s: i for i, s in enumerate(self.segments)}
+        self._product_pos = {p: i for i, p in enumerate(self.products)}
+
+        # curves over every cohort that reached each age: its total there against the same cohorts'
+        # month 0, so young cohorts never drag the older ages down; metric x segment x product x age
+        self.cohort_counts, self.totals, self.bases = accumulate(values, self.cohorts, self.dates) if sums is None else sums
+        self.ages = pd.Index(np.arange(self.totals.shape[-1]), name='months_since_register')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.retention = np.where(self.bases > 0, self.totals / np.where(self.bases > 0, self.bases, 1), np.nan)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.totals.nbytes + self.bases.nbytes + self.retention.nbytes
+
+    @property
+    def labels(self):
+        # everything but the values, JSON-serializable; cohorts are month keys
+        return {
+            'metrics': self.metrics,
+            'segments': self.segments,
+            'products': self.products,
+            'cohorts': [int(c) for c in self.cohorts],
+            'dates': [int(d) for d in self.dates],
+            'rollups': self.rollups,
+        }
+
+    @classmethod
+    def from_labels(cls, values, labels):
+        return cls(
+            values, labels['metrics'], labels['segments'], labels['products'],
+            np.asarray(labels['cohorts'], dtype='int32'), np.asarray(labels['dates'], dtype='int32'),
+            labels['rollups']
+        )
+
+    def aged(self, values):
+        # a cohort x date array gathered into cohort x age, NaN where that month is not here
+        dated = self.cohorts.to_numpy(dtype='int64')[:, None] + self.ages.to_numpy(dtype='int64')[None, :]
+        positions = self.dates.get_indexer(dated.ravel()).reshape(dated.shape)
+        return np.where(positions >= 0, values[np.arange(len(self.cohorts))[:, None], positions], np.nan)
+
+    @classmethod
+    def build(cls, dfu, rollups, metrics=retention_metrics):
+
+        # base rows only, binned in one pass; ages are the calendar month difference of the month
+        # keys, which unlike days // 30 never puts two months of one cohort on the same age
+        base = dfu[ dfu['cohort'] != ALL_COHORT ]
+
+        segment_codes, segments = pd.factorize(base['segment'], sort=True)
+        product_codes, products = pd.factorize(base['product'], sort=True)
+        cohort_codes, cohorts = pd.factorize(base['cohort'], sort=True)
+        date_codes, dates = pd.factorize(base['date'], sort=True)
+
+        n_seg, n_prod, n_coh, n_date = len(segments), len(products), len(cohorts), len(dates)
+        cell = ((segment_codes * n_prod + product_codes) * n_coh + cohort_codes) * n_date + date_codes
+        size = n_seg * n_prod * n_coh * n_date
+
+        data = base[list(metrics)].to_numpy(dtype='float64')
+        data = np.where(np.isnan(data), 0.0, data)
+
+        shape = (n_seg, n_prod, n_coh, n_date)
+        values = np.stack([np.bincount(cell, weights=data[:, i], minlength=size) for i in range(len(metrics))])
+        values = values.reshape((len(metrics),) + shape)
+        counts = np.bincount(cell, minlength=size).reshape(shape)
+
+        labels = list(rollups) + list(segments)
+        members = [np.isin(segments, [s for s in segments if keep(s)]) for keep in rollups.values()]
+
+        values = np.concatenate([np.stack([values[:, m].sum(axis=1) for m in members], axis=1), values], axis=1)
+        counts = np.concatenate([np.stack([counts[m].sum(axis=0) for m in members]), counts])
+
+        values[:, counts == 0] = np.nan
+
+        return cls(values, metrics, labels, products, cohorts, dates, rollups)
+
+    def appends(self, part):
+        # part only adds months after the last one here, for segments, products and older cohorts
+        # already here
+        return (
+            len(self.dates) > 0 and part.metrics == self.metrics and part.rollups == self.rollups
+            and part.dates.min() > self.dates[-1]
+            and set(part.segments) <= set(self.segments) and set(part.products) <= set(self.products)
+            and (part.cohorts.isin(self.cohorts) | (part.cohorts > self.cohorts[-1])).all()
+        )
+
+    def append(self, part):
+
+        # the part's months become new date columns (and its new cohorts new rows) of the same buffer;
+        # only cells outside this cube's values are written, so it and anyone still reading it see no
+        # change. Only the new cells are added to the sums, each at its own age
+        cohorts = self.cohorts.append(part.cohorts.difference(self.cohorts))
+        dates = self.dates.append(part.dates)
+        n_coh, n_date = len(self.cohorts), len(self.dates)
+
+        shape = (len(self.metrics), len(self.segments), len(self.products), len(cohorts), len(dates))
+        buffer = grown(self._buffer, self.values, shape)
+        buffer[..., :len(cohorts), n_date:len(dates)] = np.nan
+        buffer[..., n_coh:len(cohorts), :n_date] = np.nan
+        buffer[np.ix_(
+            np.arange(len(self.metrics)),
+            [self._segment_pos[s] for s in part.segments],
+            [self._product_pos[p] for p in part.products],
+            cohorts.get_indexer(part.cohorts),
+            np.arange(n_date, len(dates))
+        )] = part.values
+        values = buffer[..., :len(cohorts), :len(dates)]
+        sums = accumulate(values, cohorts, dates, n_date, (self.cohort_counts, self.totals, self.bases))
+
+        return RetentionCube(values, self.metrics, self.segments, self.products, cohorts, dates, self.rollups, buffer, sums)
+
+    def replace(self, part):
+
+        # part is a cube over whole months: those months are taken from it, everything else is kept.
+        # New months at the end are appended in place; anything else rebuilds the array and its sums
+        if self.appends(part):
+            return self.append(part)
+
+        base_segments = sorted(set(self.segments[len(self.rollups):]) | set(part.segments[len(part.rollups):]))
+        segments = self.rollups + base_segments
+        products = sorted(set(self.products) | set(part.products))
+        cohorts = self.cohorts.union(part.cohorts).sort_values()
+        dates = self.dates.union(part.dates).sort_values()
+
+        kept = np.where(self.dates.isin(part.dates), np.nan, self.values)
+
+        values = np.full((len(self.metrics), len(segments), len(products), len(cohorts), len(dates)), np.nan)
+        for cube, cube_values in ((self, kept), (part, part.values)):
+            values[np.ix_(
+                np.arange(len(self.metrics)),
+                [segments.index(s) for s in cube.segments],
+                [products.index(p) for p in cube.products],
+                cohorts.get_indexer(cube.cohorts),
+                dates.get_indexer(cube.dates)
+            )] = cube_values
+
+        return RetentionCube(values, self.metrics, segments, products, cohorts, dates, self.rollups)
+
+    def curve(self, segment, product, metric='total_merchants'):
+
+        m, s, p = self._metric_pos[metric], self._segment_pos[segment], self._product_pos[product]
+
+        return pd.DataFrame({
+            'cohorts': self.cohort_counts[m, s, p],
+            metric: self.totals[m, s, p],
+            'month_0': self.bases[m, s, p],
+            'retention': self.retention[m, s, p],
+        }, index=self.ages)
+
+    def matrix(self, segment, product, metric='total_merchants'):
+
+        # each cohort against its own month 0
+        values = self.aged(self.values[self._metric_pos[metric], self._segment_pos[segment], self._product_pos[product]])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = np.where(values[:, :1] > 0, values / np.where(values[:, :1] > 0, values[:, :1], 1), np.nan)
+
+        return pd.DataFrame(ratios, index=self.cohorts, columns=self.ages)
+
+    def at(self, age, metric='total_merchants'):
+
+        # retention at one age for every segment and product: a single slice of the curves
+        m, a = self._metric_pos[metric], self.ages.get_loc(age)
+        previous = self.retention[m, :, :, a - 1] if a > 0 else np.full(self.retention.shape[1:3], np.nan)
+
+        index = pd.MultiIndex.from_product([self.segments, self.products], names=['segment', 'product'])
+        return pd.DataFrame({
+            'cohorts': self.cohort_counts[m, :, :, a].ravel(),
+            'retention': self.retention[m, :, :, a].ravel(),
+            'previous': previous.ravel(),
+        }, index=index).reset_index()
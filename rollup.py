@@ -0,0 +1,69 @@
+import itertools
+
+import pandas as pd
+
+
+def expand_sets(rollups, sets=None):
+    # grouping sets as tuples of rolled-up dimensions; () is the base grain. None means every
+    # combination, the base grain first, in the order the dimensions are given
+    if sets is not None:
+        return [tuple(s) for s in sets]
+    dims = list(rollups)
+    return [s for n in range(len(dims) + 1) for s in itertools.combinations(dims, n)]
+
+
+def grouping_sets(frame, keys, measures, rollups, sets=None, min_count=0):
+
+    # rollups maps a dimension to named groups of its values, each a predicate on one value:
+    # {'segment': {'ALL': lambda s: True, 'ALL_ACTIVE': lambda s: s != 'inactive'}}. The frame is
+    # scanned once, for sums at the finest grain; every grouping set is then re-aggregated from
+    # those sums (or from a smaller set's), since sums of sums are exact. Predicates only ever
+    # see the distinct values of their dimension. Yields (set, labels, frame) with the keys as
+    # columns; a rolled-up key holds its group's name.
+
+    # integer sums are int64, as in SQL, so they cannot overflow
+    wide = {m: 'int64' for m in measures if frame[m].dtype.kind in 'iu' and frame[m].dtype.itemsize < 8}
+    if wide:
+        frame = frame[keys + list(measures)].astype(wide)
+    base = frame.groupby(keys, sort=False, observed=True)[list(measures)].sum(min_count=min_count)
+    sets = expand_sets(rollups, sets)
+
+    # one frame per (dimension, name) chain, each built from its prefix
+    done = {(): base}
+
+    def grouped(chain):
+        if chain not in done:
+            parent = grouped(chain[:-1])
+            dim, name = chain[-1]
+            values = parent.index.get_level_values(dim)
+            distinct = values.unique()
+            members = distinct[[bool(rollups[dim][name](v)) for v in distinct]]
+            kept = parent[ values.isin(members) ]
+            others = [k for k in keys if k != dim]
+            done[chain] = pd.concat({name: kept.groupby(level=others, sort=False, observed=True).sum(min_count=min_count)}, names=[dim]).reorder_levels(keys)
+        return done[chain]
+
+    for dims in sets:
+        for names in itertools.product(*(rollups[d] for d in dims)):
+            labels = dict(zip(dims, names))
+            yield dims, labels, grouped(tuple(zip(dims, names))).reset_index()
+
+
+def rollup(frame, keys, measures, rollups, sets=None, min_count=0):
+
+    # every grouping set stacked into one frame, keys in the dtypes of the frame: categoricals gain
+    # the group names as categories (sorted, as pipeline.concat keeps them), other keys are cast back
+    parts = [part for _, _, part in grouping_sets(frame, keys, measures, rollups, sets, min_count)]
+
+    dtypes = {}
+    for key in keys:
+        dtype = frame[key].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            names = [n for n in rollups.get(key, {})]
+            dtype = pd.CategoricalDtype(sorted(set(dtype.categories) | set(names)))
+        dtypes[key] = dtype
+
+    if not parts:
+        return pd.DataFrame({c: pd.Series(dtype=dtypes.get(c, frame[c].dtype)) for c in keys + list(measures)})
+
+    return pd.concat([p.astype(dtypes) for p in parts], ignore_index=True)
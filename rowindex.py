@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_list_like
+
+
+class RowIndex:
+
+    def __init__(self, size, keys, bounds, order, codes, rollups=None):
+
+        # per column: keys are its sorted distinct values, order its row positions sorted by value
+        # (ascending within a value), bounds where each value's block of order starts and codes each
+        # row's value as a position in keys. rollups maps a column to named groups of its values,
+        # stored as the codes they cover, or None for a group that covers every value
+        self.size = size
+        self.keys = keys
+        self.bounds = bounds
+        self.order = order
+        self.codes = codes
+        self.rollups = rollups or {}
+        # value -> code, so a selection never goes through an Index lookup
+        self.lookup = {c: {v: i for i, v in enumerate(k.tolist())} for c, k in keys.items()}
+
+    @property
+    def nbytes(self):
+        return sum(self.bounds[c].nbytes + self.order[c].nbytes + self.codes[c].nbytes for c in self.keys)
+
+    @classmethod
+    def build(cls, frame, columns=('date', 'cohort', 'segment', 'product'), rollups=None):
+
+        # one stable sort per column; codes fit in a byte or two, which numpy sorts by radix in O(rows)
+        position = 'int32' if len(frame) < 2 ** 31 else 'int64'
+        keys, bounds, order, codes = {}, {}, {}, {}
+        for column in columns:
+            column_codes, values = pd.factorize(frame[column], sort=True)
+            column_codes = column_codes.astype(np.min_scalar_type(max(len(values) - 1, 0)))
+            keys[column] = pd.Index(values, name=column)
+            codes[column] = column_codes
+            order[column] = np.argsort(column_codes, kind='stable').astype(position)
+            bounds[column] = np.concatenate([[0], np.cumsum(np.bincount(column_codes, minlength=len(values)))])
+
+        groups = {}
+        for column, named in (rollups or {}).items():
+            values = keys[column].tolist()
+            groups[column] = {}
+            for name, keep in named.items():
+                covered = [i for i, v in enumerate(values) if keep(v)]
+                groups[column][name] = None if len(covered) == len(values) else covered
+
+        return cls(len(frame), keys, bounds, order, codes, groups)
+
+    @property
+    def labels(self):
+        # everything but the per-row arrays, JSON-serializable
+        return {
+            'size': self.size,
+            'columns': list(self.keys),
+            'keys': {c: k.tolist() for c, k in self.keys.items()},
+            'bounds': {c: b.tolist() for c, b in self.bounds.items()},
+            'rollups': self.rollups,
+        }
+
+    def stacked(self):
+        # the per-row arrays, one row per column: positions in value order, and value codes
+        return np.stack([self.order[c] for c in self.keys]), np.stack([self.codes[c] for c in self.keys])
+
+    @classmethod
+    def from_labels(cls, order, codes, labels, dtypes):
+
+        # order and codes as stacked() gives them, memory-mapped from a bundle for instance: each
+        # column's arrays are rows of them, not copies. dtypes are the indexed frame's, so the keys
+        # come back as the same kind of Index
+        columns = labels['columns']
+        keys = {c: pd.Index(pd.array(labels['keys'][c], dtype=dtypes[c]), name=c) for c in columns}
+        bounds = {c: np.asarray(labels['bounds'][c], dtype='int64') for c in columns}
+
+        return cls(labels['size'], keys, bounds, dict(zip(columns, order)), dict(zip(columns, codes)), labels['rollups'])
+
+    def values(self, column):
+        return self.keys[column]
+
+    def matching(self, column, wanted):
+
+        # the codes of column a selection covers: a value, a rollup name, a list of either, or a
+        # slice of values with both ends included, as in .loc. None means every value
+        keys = self.keys[column]
+        if isinstance(wanted, slice):
+            lo = 0 if wanted.start is None else keys.searchsorted(wanted.start, 'left')
+            hi = len(keys) if wanted.stop is None else keys.searchsorted(wanted.stop, 'right')
+            return np.arange(lo, hi)
+
+        named, lookup = self.rollups.get(column, {}), self.lookup[column]
+        found = []
+        for value in (wanted if is_list_like(wanted) else [wanted]):
+            if value in named:
+                if named[value] is None:
+                    return None
+                found.extend(named[value])
+            elif value in lookup:
+                found.append(lookup[value])
+
+        return np.unique(np.asarray(found, dtype='int64'))
+
+    def plan(self, **selection):
+
+        # the blocks of the most selective column (each ascending row positions) and, for every other
+        # column selected, its codes with a mask of the ones kept; None when every row matches
+        wanted = {c: self.matching(c, w) for c, w in selection.items() if w is not None}
+        wanted = {c: codes for c, codes in wanted.items() if codes is not None}
+        if not wanted:
+            return None
+
+        sizes = {c: int((self.bounds[c][codes + 1] - self.bounds[c][codes]).sum()) for c, codes in wanted.items()}
+        column = min(sizes, key=sizes.get)
+
+        codes, bounds, order = wanted.pop(column), self.bounds[column], self.order[column]
+        blocks = [order[bounds[k]:bounds[k + 1]] for k in codes if bounds[k + 1] > bounds[k]]
+
+        checks = []
+        for other, codes in wanted.items():
+            allowed = np.zeros(len(self.keys[other]), dtype=bool)
+            allowed[codes] = True
+            checks.append((self.codes[other], allowed))
+
+        return blocks, checks
+
+    def checked(self, positions, checks):
+        for codes, allowed in checks:
+            positions = positions[ allowed[codes[positions]] ]
+        return positions
+
+    def positions(self, **selection):
+
+        # ascending row positions matching every column's selection, or None for every row. Rows come
+        # from the blocks of the most selective column and are checked against the others' codes, so
+        # the cost follows the size of those blocks, not of the table
+        plan = self.plan(**selection)
+        if plan is None:
+            return None
+
+        blocks, checks = plan
+        if len(blocks) == 1:
+            positions = blocks[0]
+        else:
+            positions = np.sort(np.concatenate(blocks)) if blocks else np.empty(0, dtype='int64')
+
+        return self.checked(positions, checks)
+
+    def select(self, frame, copy=False, **selection):
+
+        # frame is the one the index was built on, or any frame with its rows in the same order.
+        # copy=True never hands out a view of frame, for a caller that may write to the rows
+        if len(frame) != self.size:
+            raise ValueError(f"index covers {self.size} rows, the frame has {len(frame)}")
+
+        positions = self.positions(**selection)
+        if positions is None:
+            return frame.copy() if copy else frame
+        if len(positions) == 0:
+            return frame.iloc[:0].copy() if copy else frame.iloc[:0]
+        if positions[-1] - positions[0] + 1 == len(positions):
+            # one contiguous run, as any month range is in the date-major tables: a view unless
+            # copy, and even then one block copy rather than a take
+            rows = frame.iloc[positions[0]:positions[-1] + 1]
+            return rows.copy() if copy else rows
+
+        return frame.take(positions)
+
+    def chunks(self, frame, rows, **selection):
+
+        # the rows of select, in order, `rows` at a time. Positions are gathered one window of
+        # the table at a time (a binary search into each block), so nothing proportional to the
+        # selection is held: each chunk is a view of a contiguous run or a take of its own positions
+        if len(frame) != self.size:
+            raise ValueError(f"index covers {self.size} rows, the frame has {len(frame)}")
+
+        plan = self.plan(**selection)
+        if plan is None:
+            blocks, checks, lo, hi = [], [], 0, len(frame)
+        else:
+            blocks, checks = plan
+            if not blocks:
+                return
+            lo, hi = min(int(b[0]) for b in blocks), max(int(b[-1]) for b in blocks) + 1
+
+        if not checks and (plan is None or sum(len(b) for b in blocks) == hi - lo):
+            for start in range(lo, hi, rows):
+                yield frame.iloc[start:min(start + rows, hi)]
+            return
+
+        pending, count = [], 0
+        for start in range(lo, hi, rows):
+            parts = [b[np.searchsorted(b, start):np.searchsorted(b, start + rows)] for b in blocks]
+            positions = self.checked(np.sort(np.concatenate(parts)), checks)
+            if len(positions):
+                pending.append(positions)
+                count += len(positions)
+            if count >= rows:
+                positions = np.concatenate(pending)
+                yield frame.take(positions[:rows])
+                pending, count = [positions[rows:]], count - rows
+        if count:
+            yield frame.take(np.concatenate(pending))
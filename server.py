@@ -0,0 +1,381 @@
+import argparse
+import io
+import json
+import logging
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pyarrow as pa
+
+from cache import ResultCache
+from datalayer import CACHE_DIR, DATA_PATH, META_PATH, Q_WINDOW, indexed_tables, shared_datalayer
+from export import ChunkedSink, export_format, formats
+from instrument import span
+from pipeline import ALL_COHORT, as_month_key, month_label
+
+logger = logging.getLogger('datalayer.server')
+
+RESPONSE_CACHE_BYTES = 128 * 1024 * 1024
+
+JSON_TYPE = 'application/json'
+ARROW_TYPE = 'application/vnd.apache.arrow.stream'
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def wire_frame(frame):
+    # month keys go out as 'YYYY-MM' (the cohort rollup as 'ALL'); categoricals stay dictionary-encoded in Arrow
+    return frame.assign(**{c: month_label(frame[c]) for c in ('date', 'cohort') if c in frame})
+
+
+def encode(frame, fmt):
+
+    frame = wire_frame(frame)
+
+    if fmt == 'arrow':
+        sink = io.BytesIO()
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue()
+
+    return frame.to_json(orient='records').encode()
+
+
+def values(params, name):
+    # repeated or comma-separated: ?segment=SMB,micro or ?segment=SMB&segment=micro
+    return [v for value in params.get(name, []) for v in value.split(',') if v]
+
+
+def value(params, name, default=None):
+
+    given = values(params, name)
+    if len(given) > 1:
+        raise BadRequest(f"{name} takes a single value")
+
+    return given[0] if given else default
+
+
+def months(params, name):
+    try:
+        return [as_month_key(v) for v in values(params, name)]
+    except ValueError:
+        raise BadRequest(f"{name} takes 'YYYY-MM' months or 'ALL'")
+
+
+def month(params, name, default=None):
+    given = months(params, name)
+    if len(given) > 1:
+        raise BadRequest(f"{name} takes a single value")
+    if given:
+        return given[0]
+    return None if default is None else as_month_key(default)
+
+
+def known(index, **selection):
+
+    # every selected value has to be one the index has rows for, or one of its rollups: an unknown
+    # one is a mistake in the request, not an empty selection
+    for column, given in selection.items():
+        allowed = set(index.values(column).tolist()) | set(index.rollups.get(column, {}))
+        unknown = [v for v in given or [] if v not in allowed]
+        if unknown:
+            raise BadRequest(f"unknown {column}: {[month_label(v) for v in unknown]}")
+
+
+def window(params):
+
+    # ?months=N trailing months up to ?end= (default: the latest month), or ?start=&end=
+    try:
+        n = int(value(params, 'months', Q_WINDOW))
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise BadRequest("months takes a positive number of months")
+
+    return n, month(params, 'start'), month(params, 'end')
+
+
+class Response:
+
+    def __init__(self, body, content_type, status=200):
+        self.body = body
+        self.content_type = content_type
+        self.status = status
+
+    @property
+    def nbytes(self):
+        return len(self.body)
+
+
+class DataService:
+
+    def __init__(self, datalayer=shared_datalayer, cache_bytes=RESPONSE_CACHE_BYTES):
+        # datalayer returns the current DataLayer; shared_datalayer reloads it when the sources change
+        self.datalayer = datalayer
+        self.responses = ResultCache(cache_bytes)
+        self.endpoints = {
+            '/q1': self.q1,
+            '/q2': self.q2,
+            '/share': self.share,
+            '/heatmap': self.heatmap,
+            '/retention': self.retention,
+            '/unpivoted': self.unpivoted,
+        }
+
+    def q1(self, dl, params):
+        return dl.load_q1(*window(params))
+
+    def q2(self, dl, params):
+        return dl.load_q2(*window(params))
+
+    def share(self, dl, params):
+
+        segment, cohort = value(params, 'segment', 'ALL'), month(params, 'cohort', 'ALL')
+        cube = dl.cohort_cube()
+        if segment not in cube.segments:
+            raise BadRequest(f"segment must be one of {cube.segments}")
+        if cohort != ALL_COHORT and cohort not in cube.cohorts:
+            raise BadRequest(f"cohort must be 'ALL' or one of {list(month_label(cube.cohorts))}")
+
+        return dl.load_with_share(segment, cohort)
+
+    def heatmap(self, dl, params):
+
+        metric, segment = value(params, 'metric'), value(params, 'segment', 'ALL')
+        cube = dl.cohort_cube()
+        if metric not in cube.metrics:
+            raise BadRequest(f"metric must be one of {cube.metrics}")
+        if segment not in cube.segments:
+            raise BadRequest(f"segment must be one of {cube.segments}")
+
+        # one row per cohort, one column per month
+        cross_tab = dl.cohort_heatmap(metric, segment)
+
+        return cross_tab.set_axis(month_label(cross_tab.columns), axis=1).reset_index()
+
+    def retention(self, dl, params):
+
+        # ?months_since_register=N: every segment and product at that month; otherwise the curve
+        # of one segment and product, or its per-cohort matrix with ?by=cohort
+        metric, segment, product = value(params, 'metric', 'total_merchants'), value(params, 'segment', 'ALL'), value(params, 'product')
+        cube = dl.retention_cube()
+        if metric not in cube.metrics:
+            raise BadRequest(f"metric must be one of {cube.metrics}")
+
+        age = value(params, 'months_since_register')
+        if age is not None:
+            if not age.isdigit() or int(age) not in cube.ages:
+                raise BadRequest(f"months_since_register must be between 0 and {cube.ages[-1]}")
+            return dl.retention_at(int(age), metric)
+
+        if segment not in cube.segments:
+            raise BadRequest(f"segment must be one of {cube.segments}")
+        if product not in cube.products:
+            raise BadRequest(f"product must be one of {cube.products}")
+
+        if value(params, 'by') == 'cohort':
+            matrix = dl.retention_matrix(segment, product, metric)
+            return matrix.set_axis([str(a) for a in matrix.columns], axis=1).reset_index()
+
+        return dl.retention_curve(segment, product, metric).reset_index()
+
+    def unpivoted(self, dl, params):
+
+        # raw rows (tweak=1 for the values the charts use) filtered by any of date, cohort, segment
+        # (rollups included) and product through the row index, with only the columns asked for
+        selection = {
+            'segment': values(params, 'segment') or None, 'cohort': months(params, 'cohort') or None,
+            'product': values(params, 'product') or None, 'date': months(params, 'date') or None,
+        }
+        known(dl.row_index(), **selection)
+        dfu = dl.select(**selection, tweak_values_for_animation=value(params, 'tweak', '0') == '1')
+
+        columns = values(params, 'columns')
+        unknown = set(columns) - set(dfu.columns)
+        if unknown:
+            raise BadRequest(f"unknown columns: {sorted(unknown)}")
+
+        return dfu[columns] if columns else dfu
+
+    def export(self, params, fmt='csv'):
+
+        # the DataLayer and export() arguments for /export?table=&segment=&cohort=&product=&date=
+        # (or start=&end=)&columns=; the rows are streamed by the handler, never built or cached here
+        try:
+            fmt = export_format(fmt)
+        except ValueError as e:
+            raise BadRequest(str(e))
+
+        table = value(params, 'table', 'unpivoted')
+        if table not in indexed_tables:
+            raise BadRequest(f"table must be one of {list(indexed_tables)}")
+
+        # checked before anything is sent: once the status is out, an error can only cut the body short
+        dl = self.datalayer()
+        frame, index = dl.indexed(table)
+        columns = values(params, 'columns')
+        unknown = set(columns) - set(frame.columns)
+        if unknown:
+            raise BadRequest(f"unknown columns: {sorted(unknown)}")
+
+        selection = {
+            'segment': values(params, 'segment') or None, 'cohort': months(params, 'cohort') or None,
+            'product': values(params, 'product') or None, 'date': months(params, 'date') or None,
+        }
+        known(index, **selection)
+
+        return dl, {
+            'fmt': fmt, 'table': table, **selection,
+            'start': month(params, 'start'), 'end': month(params, 'end'),
+            'columns': columns or None,
+        }
+
+    def index(self, dl):
+        return {
+            'fingerprint': dl.fingerprint, 'version': str(dl.version), 'endpoints': sorted(list(self.endpoints) + ['/export']),
+            'cache': {'results': dl.results.stats(), 'responses': self.responses.stats()},
+        }
+
+    def respond(self, path, params, fmt='json'):
+
+        dl = self.datalayer()
+
+        if path == '/':
+            return Response(json.dumps(self.index(dl)).encode(), JSON_TYPE)
+
+        endpoint = self.endpoints.get(path)
+        if endpoint is None:
+            return error(404, f"no endpoint {path}")
+
+        # responses are cached encoded, per source fingerprint, so an ingest or a new data file
+        # never serves stale bytes
+        key = (path, tuple(sorted((k, tuple(v)) for k, v in params.items())), fmt, dl.fingerprint)
+
+        def compute():
+            with span('server.compute', path=path, format=fmt):
+                return Response(encode(endpoint(dl, params), fmt), ARROW_TYPE if fmt == 'arrow' else JSON_TYPE)
+
+        try:
+            return self.responses.get_or_compute(key, compute)
+        except (BadRequest, KeyError, ValueError) as e:
+            return error(400, str(e))
+        except Exception:
+            # anything else is a bug, not the request: answered all the same, so the connection survives
+            logger.exception("%s failed", path)
+            return error(500, f"{path} failed")
+
+
+def error(status, message):
+    return Response(json.dumps({'error': message}).encode(), JSON_TYPE, status)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        path = url.path.rstrip('/') or '/'
+
+        # ?format=arrow, or an Accept header asking for an Arrow stream
+        fmt = params.pop('format', [None])[-1]
+        if path == '/export':
+            return self.export(params, fmt or 'csv')
+        if fmt is None:
+            fmt = 'arrow' if ARROW_TYPE in self.headers.get('Accept', '') else 'json'
+
+        with span('server.request', path=url.path, format=fmt):
+            if fmt not in ('json', 'arrow'):
+                response = error(400, "format must be json or arrow")
+            else:
+                response = self.server.service.respond(path, params, fmt)
+
+        self.send(response)
+
+    def send(self, response):
+        self.send_response(response.status)
+        self.send_header('Content-Type', response.content_type)
+        self.send_header('Content-Length', str(len(response.body)))
+        self.end_headers()
+        self.wfile.write(response.body)
+
+    def export(self, params, fmt):
+
+        # an export can be larger than anything the server should hold, so it is written as it is
+        # read, with chunked transfer encoding, instead of going through respond() and its cache
+        try:
+            dl, arguments = self.server.service.export(params, fmt)
+        except (BadRequest, ValueError) as e:
+            return self.send(error(400, str(e)))
+
+        content_type, extension = formats[arguments['fmt']]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Disposition', f'attachment; filename="{arguments["table"]}.{extension}"')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        sink = ChunkedSink(self.wfile)
+        try:
+            with span('server.export', table=arguments['table'], format=arguments['fmt']):
+                dl.export(io.BufferedWriter(sink, 1 << 16), **arguments)
+        except Exception:
+            # the status is already sent: a body cut short without its last chunk is how the client
+            # learns the export failed
+            logger.exception("export failed")
+            self.close_connection = True
+            return
+        sink.finish()
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s", self.address_string(), format % args)
+
+
+def serve(host='127.0.0.1', port=8765, service=None):
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.service = service or DataService()
+
+    return server
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Serve DataLayer results as JSON or Arrow IPC streams')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--data', default=DATA_PATH)
+    parser.add_argument('--meta', default=META_PATH)
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--attach', default=os.environ.get('DL_ATTACH') or None, help='map the generation `artifacts.py publish` keeps current in this directory')
+    parser.add_argument('--cache-mb', type=int, default=RESPONSE_CACHE_BYTES // 2 ** 20, help='encoded responses kept in memory')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    def datalayer():
+        return shared_datalayer(args.data, args.meta, args.cache_dir, attach_dir=args.attach)
+
+    # the heavy datasets build in the background while the first requests are served
+    datalayer().warm()
+
+    server = serve(args.host, args.port, DataService(datalayer, args.cache_mb * 2 ** 20))
+    print(f"serving on http://{args.host}:{server.server_address[1]}/", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+from pipeline import ALL_COHORT, cohort_rollups, concat
+from rollup import grouping_sets
+
+
+def share_table(dfu, rollups):
+
+    # sum(avg_ticket) per selection, with SQL's NULL semantics (a group of only NaN stays NaN), for
+    # every cohort and segment plus the cohort 'ALL' and segment rollups, all from one pass over dfu.
+    # Cohort 'ALL' selects every row, including the cohort='ALL' rollup rows themselves; those rows'
+    # own groups are left out of the sets that keep cohorts apart
+    keys = ['cohort', 'date', 'segment', 'product']
+    groups = {**cohort_rollups, 'segment': rollups}
+    parts = [
+        part if 'cohort' in dims else part[ part['cohort'] != ALL_COHORT ]
+        for dims, _, part in grouping_sets(dfu, keys, ['avg_ticket'], groups, min_count=1)
+    ]
+
+    table = concat(parts)
+    table = table.astype({'cohort': 'int32', 'date': 'int32', 'segment': 'category', 'product': 'category'})
+
+    partition = ['cohort', 'date', 'segment']
+    grouped = table.groupby(partition, sort=False, observed=True)['avg_ticket']
+    total = grouped.transform('sum').where(grouped.transform('count') > 0)
+    table['percent_avg_ticket'] = table['avg_ticket'] / total
+
+    # row_number() over (partition by date, segment order by percent desc): NULLs rank last, ties by product
+    table = table.sort_values(partition + ['percent_avg_ticket', 'product'], ascending=[True, True, True, False, True], na_position='last', kind='stable', ignore_index=True)
+    table['rank'] = table.groupby(partition, sort=False, observed=True).cumcount() + 1
+
+    return table[['cohort', 'segment', 'date', 'product', 'percent_avg_ticket', 'rank']]
+
+
+class ShareTable:
+
+    def __init__(self, table, presorted=False):
+
+        # rows sorted by (cohort, segment, date, rank) so every selection is one contiguous block;
+        # a table already in that order (a saved frame) is used as is, without a copy
+        self.frame = table if presorted else table.sort_values(['cohort', 'segment', 'date', 'rank'], kind='stable', ignore_index=True)
+
+        # a block starts wherever the cohort or the segment changes from the row before
+        cohort, segment = self.frame['cohort'].to_numpy(), self.frame['segment'].cat.codes.to_numpy()
+        starts = np.flatnonzero(np.concatenate([[len(cohort) > 0], (cohort[1:] != cohort[:-1]) | (segment[1:] != segment[:-1])]))
+        stops = np.append(starts[1:], len(cohort))
+        categories = self.frame['segment'].cat.categories
+        self.offsets = {
+            (c, categories[s]): (start, stop)
+            for c, s, start, stop in zip(cohort[starts].tolist(), segment[starts].tolist(), starts.tolist(), stops.tolist())
+        }
+
+    @property
+    def nbytes(self):
+        return int(self.frame.memory_usage(deep=True).sum())
+
+    def slice(self, cohort, segment):
+
+        start, stop = self.offsets.get((cohort, segment), (0, 0))
+
+        return self.frame.iloc[start:stop][['date', 'segment', 'product', 'percent_avg_ticket', 'rank']].reset_index(drop=True)
+
+    def replace(self, part):
+
+        # part covers whole months: those months come from it, everything else is kept. Both are in
+        # (cohort, segment, date, rank) order, so the part's rows are spliced into the kept ones where
+        # a binary search on one combined key puts them, instead of sorting the whole table again
+        part = part.sort_values(['cohort', 'segment', 'date', 'rank'], kind='stable', ignore_index=True)
+        table = concat([self.frame, part])
+        n_old = len(self.frame)
+        keep = np.flatnonzero(~self.frame['date'].isin(part['date'].unique()).to_numpy())
+
+        keys = [pd.factorize(table[c].cat.codes if c == 'segment' else table[c], sort=True) for c in ('cohort', 'segment', 'date', 'rank')]
+        key = np.zeros(len(table), dtype='int64')
+        for codes, values in keys:
+            key = key * len(values) + codes
+
+        inserted = np.searchsorted(key[keep], key[n_old:], side='right') + np.arange(len(part))
+        rows = np.ones(len(keep) + len(part), dtype=bool)
+        rows[inserted] = False
+        order = np.empty(len(rows), dtype='int64')
+        order[rows] = keep
+        order[inserted] = np.arange(n_old, len(table))
+
+        return ShareTable(table.take(order).reset_index(drop=True), presorted=True)
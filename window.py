@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+from pipeline import ALL_COHORT
+
+
+class WindowIndex:
+
+    def __init__(self, groups, months, monthly):
+
+        # monthly maps each measure (plus 'months', 1 where the group has rows) to a dense
+        # group x month array of sums; prefixes hold their running totals along the sorted months
+        self.groups = groups
+        self.months = np.asarray(months, dtype='int32')
+        self.monthly = monthly
+        self.prefix = {
+            name: np.concatenate([np.zeros((len(groups), 1), dtype=values.dtype), values.cumsum(axis=1)], axis=1)
+            for name, values in monthly.items()
+        }
+
+    @property
+    def nbytes(self):
+        return sum(v.nbytes for v in self.monthly.values()) + sum(v.nbytes for v in self.prefix.values())
+
+    @classmethod
+    def build(cls, dfu, measures=('total_amount', 'total_merchants'), keys=('segment', 'product')):
+
+        # base rows only: the cohort='ALL' rollup rows would count every month twice
+        base = dfu[ dfu['cohort'] != ALL_COHORT ]
+        sums = base.groupby(list(keys) + ['date'], sort=True, observed=True)[list(measures)].sum()
+
+        group_index = sums.index.droplevel('date')
+        group_codes, groups = pd.factorize(group_index, sort=True)
+        month_codes, months = pd.factorize(sums.index.get_level_values('date'), sort=True)
+
+        monthly = {}
+        for measure in measures:
+            values = np.zeros((len(groups), len(months)), dtype=sums[measure].dtype)
+            values[group_codes, month_codes] = sums[measure].to_numpy()
+            monthly[measure] = values
+        monthly['months'] = np.zeros((len(groups), len(months)), dtype='int64')
+        monthly['months'][group_codes, month_codes] = 1
+
+        return cls(pd.MultiIndex.from_tuples(groups, names=list(keys)), months, monthly)
+
+    def replace(self, part):
+
+        # part is an index over whole months: those months are taken from it, everything else is kept
+        groups = self.groups.union(part.groups).sort_values()
+        months = np.union1d(self.months, part.months)
+        kept = ~np.isin(self.months, part.months)
+
+        monthly = {}
+        for name, values in self.monthly.items():
+            merged = np.zeros((len(groups), len(months)), dtype=np.result_type(values.dtype, part.monthly[name].dtype))
+            merged[np.ix_(groups.get_indexer(self.groups), np.searchsorted(months, self.months[kept]))] = values[:, kept]
+            merged[np.ix_(groups.get_indexer(part.groups), np.searchsorted(months, part.months))] = part.monthly[name]
+            monthly[name] = merged
+
+        return WindowIndex(groups, months, monthly)
+
+    def latest(self):
+        return int(self.months[-1])
+
+    def totals(self, start, end):
+
+        # sums over every month in [start, end] for each group with rows in it, two lookups per group
+        lo, hi = np.searchsorted(self.months, start, 'left'), np.searchsorted(self.months, end, 'right')
+        totals = pd.DataFrame({name: prefix[:, hi] - prefix[:, lo] for name, prefix in self.prefix.items()}, index=self.groups)
+
+        return totals[ totals['months'] > 0 ].reset_index()
+
+    def trailing(self, months, end=None):
+        # month keys are consecutive integers, so the window is a key range
+        end = self.latest() if end is None else end
+        return self.totals(end - months + 1, end)